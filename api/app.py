@@ -1,11 +1,19 @@
-from config import Flask
+from config import Flask, Request, tempfile, UPLOAD_SPOOL_MAX_BYTES
 from route_chat_user import register_route_chat_user
 from route_document_user import register_route_document_user
 from route_transform_user import register_route_transform_user
 from route_action_user import register_route_action_user
+from process_document import resume_ingestion_jobs, resume_deletion_jobs
+from process_jobs import schedule_job_sweep
 
 #***************** Flask App *****************
+class NexusRequest(Request):
+    # Keep uploads up to UPLOAD_SPOOL_MAX_BYTES in memory and only spill larger ones to disk
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_BYTES, mode='rb+')
+
 app = Flask(__name__)
+app.request_class = NexusRequest
 app.config['VERSION'] = '0.75'
 
 #***************** Routes *****************
@@ -30,6 +38,13 @@ register_route_transform_user(app)
 # Routes that handle the actions that can be performed in workflows
 register_route_action_user(app)
 
+#***************** Jobs *****************
+# Resume or fail background jobs that were interrupted by a restart, then keep
+# sweeping for jobs left stale by other instances
+resume_ingestion_jobs()
+resume_deletion_jobs()
+schedule_job_sweep([resume_ingestion_jobs, resume_deletion_jobs])
+
 #***************** Main *****************
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -1,18 +1,36 @@
 import os
 import requests
 from datetime import datetime, timezone
-from flask import Flask, redirect, jsonify, render_template, request, send_from_directory, url_for, flash, session
+from flask import Flask, Request, Response, stream_with_context, redirect, jsonify, render_template, request, send_from_directory, url_for, flash, session
 import uuid
 from datetime import datetime, timezone
 from werkzeug.utils import secure_filename
 import openai
 from azure.cosmos import CosmosClient, exceptions
 import tempfile
+import io
+import codecs
+from azure.core import MatchConditions
 from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError
 from azure.ai.documentintelligence import DocumentIntelligenceClient
 from azure.ai.documentintelligence.models import AnalyzeResult, AnalyzeOutputOption
 import markdown
 import json
+import base64
+import time
+import hashlib
+import sqlite3
+import threading
+import fcntl
+import socket
+import re
+import itertools
+from collections import deque, OrderedDict
+from functools import lru_cache
+from contextlib import contextmanager
+import tiktoken
+from concurrent.futures import ThreadPoolExecutor, wait
 import numpy as np
 from sklearn.metrics.pairwise import cosine_similarity
 from azure.search.documents import SearchClient
@@ -29,18 +47,28 @@ AZURE_OPENAI_ENDPOINT = os.environ.get("AZURE_OPENAI_ENDPOINT")
 AZURE_OPENAI_API_VERSION = os.environ.get("AZURE_OPENAI_API_VERSION")
 AZURE_OPENAI_LLM_MODEL = os.environ.get("AZURE_OPENAI_LLM_MODEL")
 AZURE_OPENAI_EMBEDDING_MODEL = os.environ.get("AZURE_OPENAI_EMBEDDING_MODEL")
+AZURE_OPENAI_EMBEDDING_BATCH_SIZE = int(os.environ.get("AZURE_OPENAI_EMBEDDING_BATCH_SIZE", 16))
+AZURE_OPENAI_EMBEDDING_MAX_WORKERS = int(os.environ.get("AZURE_OPENAI_EMBEDDING_MAX_WORKERS", 4))
+AZURE_OPENAI_EMBEDDING_MAX_RETRIES = int(os.environ.get("AZURE_OPENAI_EMBEDDING_MAX_RETRIES", 3))
 
 AZURE_COSMOS_ENDPOINT = os.environ.get("AZURE_COSMOS_ENDPOINT")
 AZURE_COSMOS_KEY = os.environ.get("AZURE_COSMOS_KEY")
 AZURE_COSMOS_DB_NAME = os.environ.get("AZURE_COSMOS_DB_NAME")
 AZURE_COSMOS_CONVERSATIONS_CONTAINER_NAME = os.environ.get('AZURE_COSMOS_CONVERSTATIONS_CONTAINER_NAME')
+AZURE_COSMOS_CONVERSATION_TURNS_CONTAINER_NAME = os.environ.get('AZURE_COSMOS_CONVERSATION_TURNS_CONTAINER_NAME')
+AZURE_COSMOS_CONVERSATION_INDEX_CONTAINER_NAME = os.environ.get('AZURE_COSMOS_CONVERSATION_INDEX_CONTAINER_NAME')
 AZURE_COSMOS_DOCUMENTS_CONTAINER_NAME = os.environ.get('AZURE_COSMOS_DOCUMENTS_CONTAINER_NAME')
 AZURE_COSMOS_ACTIONS_CONTAINER_NAME = os.environ.get('AZURE_COSMOS_ACTIONS_CONTAINER_NAME')
 AZURE_COSMOS_WORKFLOWS_CONTAINER_NAME = os.environ.get('AZURE_COSMOS_WORKFLOWS_CONTAINER_NAME')
 AZURE_COSMOS_TRANSFORMS_CONTAINER_NAME = os.environ.get('AZURE_COSMOS_TRANSFORMS_CONTAINER_NAME')
+AZURE_COSMOS_JOBS_CONTAINER_NAME = os.environ.get('AZURE_COSMOS_JOBS_CONTAINER_NAME')
 
 AZURE_DOCUMENT_INTELLIGENCE_ENDPOINT = os.environ.get("AZURE_DOCUMENT_INTELLIGENCE_ENDPOINT")
 AZURE_DOCUMENT_INTELLIGENCE_KEY = os.environ.get("AZURE_DOCUMENT_INTELLIGENCE_KEY")
+AZURE_DOCUMENT_INTELLIGENCE_FILE_EXTENSIONS = ['.pdf', '.docx', '.xlsx', '.pptx', '.html',
+                                               '.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif', '.heif']
+AZURE_DOCUMENT_INTELLIGENCE_MAX_WORKERS = int(os.environ.get("AZURE_DOCUMENT_INTELLIGENCE_MAX_WORKERS", 4))
+AZURE_DOCUMENT_INTELLIGENCE_PAGES_PER_RANGE = int(os.environ.get("AZURE_DOCUMENT_INTELLIGENCE_PAGES_PER_RANGE", 50))
 
 AZURE_BING_KEY = os.environ.get('AZURE_BING_KEY')
 AZURE_BING_ENDPOINT = os.environ.get('AZURE_BING_ENDPOINT')
@@ -49,6 +77,58 @@ AZURE_AI_SEARCH_ENDPOINT = os.environ.get('AZURE_AI_SEARCH_ENDPOINT')
 AZURE_AI_SEARCH_KEY = os.environ.get('AZURE_AI_SEARCH_KEY')
 AZURE_AI_SEARCH_USER_INDEX = os.environ.get('AZURE_AI_SEARCH_USER_INDEX')
 AZURE_AI_SEARCH_GROUP_INDEX= os.environ.get('AZURE_AI_SEARCH_GROUP_INDEX')
+AZURE_AI_SEARCH_VECTOR_TYPE = os.environ.get('AZURE_AI_SEARCH_VECTOR_TYPE', 'Edm.Half')
+AZURE_AI_SEARCH_BATCH_MAX_DOCUMENTS = int(os.environ.get('AZURE_AI_SEARCH_BATCH_MAX_DOCUMENTS', 50))
+AZURE_AI_SEARCH_BATCH_MAX_BYTES = int(os.environ.get('AZURE_AI_SEARCH_BATCH_MAX_BYTES', 4 * 1024 * 1024))
+AZURE_AI_SEARCH_MAX_WORKERS = int(os.environ.get('AZURE_AI_SEARCH_MAX_WORKERS', 4))
+AZURE_AI_SEARCH_MAX_RETRIES = int(os.environ.get('AZURE_AI_SEARCH_MAX_RETRIES', 3))
+
+# 'azure' uses the Azure AI Search user index, 'local' keeps each user's vectors on this host
+NEXUS_SEARCH_BACKEND = os.environ.get('NEXUS_SEARCH_BACKEND', 'azure')
+
+UPLOAD_SPOOL_MAX_BYTES = int(os.environ.get('UPLOAD_SPOOL_MAX_BYTES', 8 * 1024 * 1024))
+
+# Local caches use SQLite WAL, memory-mapped files and flock, so they must live on local disk.
+# On App Service /home is a network share and must not be used.
+NEXUS_CACHE_DIR = os.environ.get('NEXUS_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'nexus-cache'))
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get('EMBEDDING_CACHE_MAX_ENTRIES', 20000))
+QUERY_EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get('QUERY_EMBEDDING_CACHE_MAX_ENTRIES', 1000))
+QUERY_EMBEDDING_CACHE_TTL_SECONDS = int(os.environ.get('QUERY_EMBEDDING_CACHE_TTL_SECONDS', 3600))
+SEARCH_RESULT_CACHE_MAX_ENTRIES = int(os.environ.get('SEARCH_RESULT_CACHE_MAX_ENTRIES', 1000))
+SEARCH_RESULT_CACHE_TTL_SECONDS = int(os.environ.get('SEARCH_RESULT_CACHE_TTL_SECONDS', 600))
+SEARCH_RESULT_CACHE_SETTLE_SECONDS = int(os.environ.get('SEARCH_RESULT_CACHE_SETTLE_SECONDS', 5))
+CONVERSATION_CACHE_MAX_ENTRIES = int(os.environ.get('CONVERSATION_CACHE_MAX_ENTRIES', 1000))
+CONVERSATION_CACHE_TTL_SECONDS = int(os.environ.get('CONVERSATION_CACHE_TTL_SECONDS', 300))
+CONVERSATION_CACHE_MAX_BYTES = int(os.environ.get('CONVERSATION_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+CONVERSATION_PREVIEW_MAX_CHARS = int(os.environ.get('CONVERSATION_PREVIEW_MAX_CHARS', 200))
+SEARCH_BATCH_MAX_QUERIES = int(os.environ.get('SEARCH_BATCH_MAX_QUERIES', 50))
+SEARCH_RERANK_CANDIDATE_MULTIPLIER = int(os.environ.get('SEARCH_RERANK_CANDIDATE_MULTIPLIER', 4))
+CHUNK_EXPORT_PAGE_SIZE = int(os.environ.get('CHUNK_EXPORT_PAGE_SIZE', 500))
+SEARCH_SOURCE_TIMEOUT_SECONDS = float(os.environ.get('SEARCH_SOURCE_TIMEOUT_SECONDS', 2.0))
+SEARCH_RRF_K = int(os.environ.get('SEARCH_RRF_K', 60))
+LOCAL_VECTOR_INDEX_DIR = os.environ.get('LOCAL_VECTOR_INDEX_DIR', os.path.join(NEXUS_CACHE_DIR, 'vector-index'))
+EXTRACTION_CACHE_MAX_ENTRIES = int(os.environ.get('EXTRACTION_CACHE_MAX_ENTRIES', 5000))
+EXTRACTION_CACHE_MAX_BYTES = int(os.environ.get('EXTRACTION_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+EXTRACTION_CACHE_MAX_AGE_SECONDS = int(os.environ.get('EXTRACTION_CACHE_MAX_AGE_SECONDS', 7 * 24 * 3600))
+
+CHUNK_SIZE_TOKENS = int(os.environ.get('CHUNK_SIZE_TOKENS', 500))
+CHUNK_OVERLAP_TOKENS = int(os.environ.get('CHUNK_OVERLAP_TOKENS', 50))
+INGESTION_WINDOW_CHUNKS = int(os.environ.get('INGESTION_WINDOW_CHUNKS', 128))
+
+CHAT_MODEL_CONTEXT_TOKENS = int(os.environ.get('CHAT_MODEL_CONTEXT_TOKENS', 128000))  # gpt-4o
+CHAT_REPLY_RESERVED_TOKENS = int(os.environ.get('CHAT_REPLY_RESERVED_TOKENS', 4096))
+# The history budget is kept modest for cost and latency, and never exceeds what the model can take
+CHAT_CONTEXT_MAX_TOKENS = min(int(os.environ.get('CHAT_CONTEXT_MAX_TOKENS', 6000)), CHAT_MODEL_CONTEXT_TOKENS - CHAT_REPLY_RESERVED_TOKENS)
+CHAT_SUMMARY_MAX_TOKENS = int(os.environ.get('CHAT_SUMMARY_MAX_TOKENS', 512))
+CHAT_SUMMARY_ENTRY_MAX_TOKENS = int(os.environ.get('CHAT_SUMMARY_ENTRY_MAX_TOKENS', 2000))
+CHAT_SUMMARY_SLICE_MAX_TOKENS = int(os.environ.get('CHAT_SUMMARY_SLICE_MAX_TOKENS', 16000))
+
+JOB_MAX_WORKERS = int(os.environ.get('JOB_MAX_WORKERS', 2))
+JOB_STAGING_DIR = os.environ.get('JOB_STAGING_DIR', os.path.join(NEXUS_CACHE_DIR, 'jobs'))
+JOB_STAGING_MIN_BYTES = int(os.environ.get('JOB_STAGING_MIN_BYTES', 8 * 1024 * 1024))
+JOB_INSTANCE_ID = os.environ.get('WEBSITE_INSTANCE_ID', socket.gethostname())
+JOB_STALE_SECONDS = int(os.environ.get('JOB_STALE_SECONDS', 30 * 60))
+JOB_SWEEP_SECONDS = int(os.environ.get('JOB_SWEEP_SECONDS', 5 * 60))
 
 #***************** Clients *****************
 
@@ -61,10 +141,16 @@ cosmos_client = CosmosClient(AZURE_COSMOS_ENDPOINT, AZURE_COSMOS_KEY)
 database = cosmos_client.get_database_client(AZURE_COSMOS_DB_NAME)
 
 conversations_container = database.get_container_client(AZURE_COSMOS_CONVERSATIONS_CONTAINER_NAME)
+conversation_turns_container = database.get_container_client(AZURE_COSMOS_CONVERSATION_TURNS_CONTAINER_NAME)  # Partition key is /conversation_id
+conversation_index_container = database.get_container_client(AZURE_COSMOS_CONVERSATION_INDEX_CONTAINER_NAME)  # Partition key is /user_id
 documents_container = database.get_container_client(AZURE_COSMOS_DOCUMENTS_CONTAINER_NAME)
 actions_container = database.get_container_client(AZURE_COSMOS_ACTIONS_CONTAINER_NAME)
 workflows_container = database.get_container_client(AZURE_COSMOS_WORKFLOWS_CONTAINER_NAME)
 transforms_container = database.get_container_client(AZURE_COSMOS_TRANSFORMS_CONTAINER_NAME)
+jobs_container = database.get_container_client(AZURE_COSMOS_JOBS_CONTAINER_NAME)
+
+# Tokenizer shared by the embedding (text-embedding-ada-002) and chat (gpt-4) models
+tokenizer = tiktoken.get_encoding("cl100k_base")
 
 document_intelligence_client = DocumentIntelligenceClient(
     endpoint=AZURE_DOCUMENT_INTELLIGENCE_ENDPOINT,
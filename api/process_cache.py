@@ -0,0 +1,169 @@
+from config import os, sqlite3, threading, time, OrderedDict
+
+#***************** Classes *****************
+# The classes support local caching
+
+class LocalCacheStore:
+    # A size-bounded key/value store kept in a local SQLite file so it survives
+    # restarts and is shared by every worker process on the same host.
+    # Entries older than max_age seconds expire, and once max_entries or
+    # max_bytes is exceeded the least recently used entries are evicted.
+
+    def __init__(self, path, max_entries, max_bytes=None, max_age=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS cache (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    last_used REAL NOT NULL,
+                    created_at REAL NOT NULL DEFAULT 0,
+                    size INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+
+            # Add the columns that stores created by earlier versions are missing
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(cache)")]
+            if 'created_at' not in columns:
+                self.connection.execute("ALTER TABLE cache ADD COLUMN created_at REAL NOT NULL DEFAULT 0")
+            if 'size' not in columns:
+                self.connection.execute("ALTER TABLE cache ADD COLUMN size INTEGER NOT NULL DEFAULT 0")
+
+            self.connection.execute("CREATE INDEX IF NOT EXISTS cache_last_used ON cache (last_used)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS cache_created_at ON cache (created_at)")
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        found = {}
+        keys = list(dict.fromkeys(keys))
+        now = time.time()
+        oldest = now - self.max_age if self.max_age else 0
+
+        with self.lock, self.connection:
+            # Look the keys up in slices to stay under SQLite's parameter limit
+            for i in range(0, len(keys), 500):
+                key_slice = keys[i:i + 500]
+                placeholders = ",".join("?" for _ in key_slice)
+                rows = self.connection.execute(
+                    f"SELECT key, value FROM cache WHERE key IN ({placeholders}) AND created_at >= ?",
+                    key_slice + [oldest]
+                ).fetchall()
+                found.update(rows)
+
+            # Mark the hits as recently used so they survive eviction
+            if found:
+                self.connection.executemany(
+                    "UPDATE cache SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found]
+                )
+
+        return found
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, items):
+        if not items:
+            return
+
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO cache (key, value, last_used, created_at, size) VALUES (?, ?, ?, ?, ?)",
+                [(key, value, now, now, len(value)) for key, value in items.items()]
+            )
+            self.evict(now)
+
+    def evict(self, now):
+        # Drop the entries that are older than max_age
+        if self.max_age:
+            self.connection.execute("DELETE FROM cache WHERE created_at < ?", (now - self.max_age,))
+
+        # Drop the least recently used entries beyond max_entries
+        count = self.connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        if count > self.max_entries:
+            self.connection.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,)
+            )
+
+        # Drop the least recently used entries until the total size fits in max_bytes
+        if self.max_bytes:
+            total_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+            if total_bytes > self.max_bytes:
+                evicted_keys = []
+                for key, size in self.connection.execute("SELECT key, size FROM cache ORDER BY last_used"):
+                    if total_bytes <= self.max_bytes:
+                        break
+                    evicted_keys.append((key,))
+                    total_bytes -= size
+                self.connection.executemany("DELETE FROM cache WHERE key = ?", evicted_keys)
+
+class MemoryCache:
+    # An in-process LRU cache. Entries expire ttl seconds after they are set, and once
+    # max_entries or max_bytes (counted from the size given to set) is exceeded the least
+    # recently used entries are evicted. Hits and misses are counted so the cache's
+    # effectiveness can be checked.
+
+    def __init__(self, max_entries, ttl=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (expires_at, value, size)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (entry[0] is not None and entry[0] < time.monotonic()):
+                if entry is not None:
+                    self.remove(key)
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, size=0):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self.lock:
+            self.remove(key)
+
+            # A value larger than the whole cache is not kept at all
+            if self.max_bytes and size > self.max_bytes:
+                return
+
+            self.entries[key] = (expires_at, value, size)
+            self.total_bytes += size
+
+            # Drop the least recently used entries beyond max_entries or max_bytes
+            while len(self.entries) > self.max_entries or (self.max_bytes and self.total_bytes > self.max_bytes):
+                self.remove(next(iter(self.entries)))
+
+    def delete(self, key):
+        with self.lock:
+            self.remove(key)
+
+    def remove(self, key):
+        # Callers hold the lock
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.total_bytes, "hits": self.hits, "misses": self.misses}
@@ -1,68 +1,283 @@
-from config import openai, document_intelligence_client, AZURE_OPENAI_EMBEDDING_MODEL, AnalyzeResult, AnalyzeOutputOption
+from config import openai, document_intelligence_client, AZURE_OPENAI_EMBEDDING_MODEL, AZURE_OPENAI_EMBEDDING_BATCH_SIZE, AZURE_OPENAI_EMBEDDING_MAX_WORKERS, AZURE_OPENAI_EMBEDDING_MAX_RETRIES, AnalyzeResult, AnalyzeOutputOption, ThreadPoolExecutor, time, hashlib, np, os, NEXUS_CACHE_DIR, EMBEDDING_CACHE_MAX_ENTRIES, CHUNK_SIZE_TOKENS, CHUNK_OVERLAP_TOKENS, tokenizer, re, codecs, deque, lru_cache, AZURE_DOCUMENT_INTELLIGENCE_MAX_WORKERS, AZURE_DOCUMENT_INTELLIGENCE_PAGES_PER_RANGE, AZURE_DOCUMENT_INTELLIGENCE_FILE_EXTENSIONS, json, EXTRACTION_CACHE_MAX_ENTRIES, EXTRACTION_CACHE_MAX_BYTES, EXTRACTION_CACHE_MAX_AGE_SECONDS, QUERY_EMBEDDING_CACHE_MAX_ENTRIES, QUERY_EMBEDDING_CACHE_TTL_SECONDS
+from process_cache import LocalCacheStore, MemoryCache
+
+#***************** Caches *****************
+# Embeddings keyed by a hash of (chunk text, embedding model)
+embedding_cache = LocalCacheStore(os.path.join(NEXUS_CACHE_DIR, 'embeddings.db'), EMBEDDING_CACHE_MAX_ENTRIES)
+
+# Extracted text keyed by (file SHA-256 digest, extractor type)
+extraction_cache = LocalCacheStore(
+    os.path.join(NEXUS_CACHE_DIR, 'extractions.db'),
+    EXTRACTION_CACHE_MAX_ENTRIES,
+    max_bytes=EXTRACTION_CACHE_MAX_BYTES,
+    max_age=EXTRACTION_CACHE_MAX_AGE_SECONDS
+)
+
+# Search query embeddings kept in process memory for the search hot path
+query_embedding_cache = MemoryCache(QUERY_EMBEDDING_CACHE_MAX_ENTRIES, ttl=QUERY_EMBEDDING_CACHE_TTL_SECONDS)
 
 #***************** Functions *****************
 # The functions support content processing
 
-def extract_text_file(file_path):
-    with open(file_path, 'r', encoding='utf-8') as f:
-        return f.read()
-
-def extract_markdown_file(file_path):
-    with open(file_path, 'r', encoding='utf-8') as f:
-        return f.read()
-
-def extract_content_with_azure_di(file_path):
-    with open(file_path, "rb") as f:
-        poller = document_intelligence_client.begin_analyze_document(
-            model_id="prebuilt-layout",
-            analyze_request=f,
-            output=[AnalyzeOutputOption.FIGURES],
-            content_type="application/octet-stream"
-        )
+def extract_file_text(file, file_ext):
+    # file is any seekable binary stream: an upload's spooled stream or a staged file
+    extractor_type = get_extractor_type(file_ext)
+
+    # Return the cached text if the same bytes were extracted the same way before
+    cache_key = f"{hash_file(file)}:{extractor_type}"
+    cached_text = extraction_cache.get(cache_key)
+    if cached_text is not None:
+        return cached_text.decode('utf-8')
+
+    # Use existing extraction functions
+    if extractor_type == 'azure_di':
+        extracted_text = extract_content_with_azure_di(file)
+    elif extractor_type == 'text':
+        extracted_text = extract_text_file(file)
+    elif extractor_type == 'markdown':
+        extracted_text = extract_markdown_file(file)
+    else:
+        extracted_text = json.dumps(json.load(file))
+
+    extraction_cache.set(cache_key, extracted_text.encode('utf-8'))
+    return extracted_text
+
+def get_extractor_type(file_ext):
+    if file_ext in AZURE_DOCUMENT_INTELLIGENCE_FILE_EXTENSIONS:
+        return 'azure_di'
+    elif file_ext == '.txt':
+        return 'text'
+    elif file_ext == '.md':
+        return 'markdown'
+    elif file_ext == '.json':
+        return 'json'
+    else:
+        raise Exception('Unsupported file type')
+
+def hash_file(file):
+    # Hash the stream in blocks, then rewind it for the extractor
+    digest = hashlib.sha256()
+    file.seek(0)
+    for block in iter(lambda: file.read(1024 * 1024), b''):
+        digest.update(block)
+    file.seek(0)
+    return digest.hexdigest()
+
+def extract_text_file(file):
+    return file.read().decode('utf-8').replace('\r\n', '\n')
+
+def extract_markdown_file(file):
+    return file.read().decode('utf-8').replace('\r\n', '\n')
+
+def extract_content_with_azure_di(file):
+    analyses = analyze_content_with_azure_di(file.read())
+    return get_analyses_text(analyses)
+
+def extract_content_and_figures_with_azure_di(file):
+    # Returns the text and the document's figures, with each figure's image kept in memory
+    analyses = analyze_content_with_azure_di(file.read(), include_figures=True)
+
+    figures = [
+        (result.model_id, operation_id, figure)
+        for result, operation_id in analyses
+        for figure in (result.figures or []) if figure.id
+    ]
+
+    # Fetch the figure images concurrently
+    with ThreadPoolExecutor(max_workers=AZURE_DOCUMENT_INTELLIGENCE_MAX_WORKERS) as executor:
+        images = list(executor.map(
+            lambda item: get_figure_image(item[0], item[1], item[2].id),
+            figures
+        ))
+
+    figures_info = [
+        {
+            "figure_id": figure.id,
+            "caption": figure.caption.content if figure.caption else None,
+            "image": image
+        }
+        for (model_id, operation_id, figure), image in zip(figures, images)
+    ]
+
+    return get_analyses_text(analyses), figures_info
+
+def analyze_content_with_azure_di(data, include_figures=False):
+    # Split large PDFs into page ranges that are analyzed concurrently
+    page_ranges = get_page_ranges(data)
+    analyses = None
+    if len(page_ranges) > 1:
+        try:
+            with ThreadPoolExecutor(max_workers=AZURE_DOCUMENT_INTELLIGENCE_MAX_WORKERS) as executor:
+                analyses = list(executor.map(
+                    lambda pages: analyze_document_with_azure_di(data, include_figures, pages),
+                    page_ranges
+                ))
+        except Exception as e:
+            # The page count is only an estimate, so fall back to one whole-document call
+            #print(f"Error analyzing page ranges, retrying whole document: {str(e)}")
+            analyses = None
+    if analyses is None:
+        analyses = [analyze_document_with_azure_di(data, include_figures)]
+    return analyses
+
+def get_analyses_text(analyses):
+    # Assemble the text in page-range order, then span order within each range
+    text_parts = []
+    for result, operation_id in analyses:
+        text_parts.extend(get_result_text_parts(result))
+    return "".join(text_parts)
+
+def analyze_document_with_azure_di(data, include_figures=False, pages=None):
+    # Only ask Document Intelligence to render figures when the caller wants them
+    poller = document_intelligence_client.begin_analyze_document(
+        model_id="prebuilt-layout",
+        analyze_request=data,
+        pages=pages,
+        output=[AnalyzeOutputOption.FIGURES] if include_figures else None,
+        content_type="application/octet-stream"
+    )
     result: AnalyzeResult = poller.result()
-    operation_id = poller.details["operation_id"]
+    return result, poller.details["operation_id"]
 
-    extracted_text = ""
+def get_result_text_parts(result):
+    text_parts = []
 
     if result.paragraphs:
         paragraphs = sorted(result.paragraphs, key=lambda p: p.spans[0].offset)
         for paragraph in paragraphs:
-            extracted_text += paragraph.content + "\n\n"
+            text_parts.append(paragraph.content)
+            text_parts.append("\n\n")
     else:
         for page in result.pages:
             for line in page.lines:
-                extracted_text += line.content + "\n"
-            extracted_text += "\n"
-
-    if result.figures:
-        figures_info = []
-        for figure in result.figures:
-            if figure.id:
-                response = document_intelligence_client.get_analyze_result_figure(
-                    model_id=result.model_id,
-                    result_id=operation_id,
-                    figure_id=figure.id
-                )
-                figure_filename = f"{figure.id}.png"
-                with open(figure_filename, "wb") as writer:
-                    writer.writelines(response)
-                figures_info.append(figure_filename)
+                text_parts.append(line.content)
+                text_parts.append("\n")
+            text_parts.append("\n")
 
-    return extracted_text
+    return text_parts
+
+def get_page_ranges(data):
+    # Page ranges such as "1-50", "51-100"; a single None range analyzes everything
+    page_count = count_pdf_pages(data)
+    pages_per_range = AZURE_DOCUMENT_INTELLIGENCE_PAGES_PER_RANGE
+    if not page_count or page_count <= pages_per_range:
+        return [None]
+
+    return [
+        f"{start}-{min(start + pages_per_range - 1, page_count)}"
+        for start in range(1, page_count + 1, pages_per_range)
+    ]
+
+def count_pdf_pages(data):
+    # Read the page count from the /Count of the PDF's page tree root. Returns
+    # None for non-PDFs and for PDFs whose page tree is inside compressed
+    # object streams, in which case the document is analyzed in one call.
+    if not data.startswith(b"%PDF"):
+        return None
+
+    counts = []
+    for match in re.finditer(rb"/Type\s*/Pages\b", data):
+        # Look for /Count inside the dictionary that holds this /Type entry
+        start = data.rfind(b"<<", max(0, match.start() - 4096), match.start())
+        end = data.find(b">>", match.end(), match.end() + 4096)
+        if start == -1 or end == -1:
+            continue
+        count = re.search(rb"/Count\s+(\d+)", data[start:end])
+        if count:
+            counts.append(int(count.group(1)))
 
-def chunk_text(text, chunk_size=500, overlap=50):
-    words = text.split()
-    chunks = []
-    for i in range(0, len(words), chunk_size - overlap):
-        chunk = ' '.join(words[i:i + chunk_size])
-        chunks.append(chunk)
-    return chunks
+    return max(counts) if counts else None
+
+def get_figure_image(model_id, operation_id, figure_id):
+    response = document_intelligence_client.get_analyze_result_figure(
+        model_id=model_id,
+        result_id=operation_id,
+        figure_id=figure_id
+    )
+    return b"".join(response)
+
+def chunk_text(text, chunk_size=CHUNK_SIZE_TOKENS, overlap=CHUNK_OVERLAP_TOKENS):
+    # Lazily yield chunks of about chunk_size tokens, each sharing about overlap
+    # tokens with the previous one. Only the words of the current chunk are held
+    # in memory, and each chunk carries its character offsets into the text.
+    window = deque()  # (start, end, tokens) for each word in the current chunk
+    window_tokens = 0
+    previous_word_end = 0  # end of the word just before the window
+    pending = False  # True once the window holds words not yet yielded
+
+    for word_start, word_end, word_tokens in iter_words(text, chunk_size):
+        window.append((word_start, word_end, word_tokens))
+        window_tokens += word_tokens
+        pending = True
+
+        if window_tokens >= chunk_size:
+            yield make_chunk(text, window, previous_word_end)
+            pending = False
+
+            # Keep only the trailing words that fit in the overlap
+            while window and window_tokens > overlap:
+                word_start, previous_word_end, word_tokens = window.popleft()
+                window_tokens -= word_tokens
+
+    if pending:
+        yield make_chunk(text, window, previous_word_end)
+
+def iter_words(text, chunk_size):
+    # Yield (start, end, tokens) for each word. A word longer than chunk_size tokens,
+    # such as a base64 data URI, is split into slices of chunk_size tokens so no
+    # chunk grows past what the embedding model accepts.
+    for match in re.finditer(r'\S+', text):
+        word = match.group()
+        word_tokens = count_word_tokens(word)
+        if word_tokens <= chunk_size:
+            yield match.start(), match.end(), word_tokens
+            continue
+
+        tokens = tokenizer.encode(word, disallowed_special=())
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        char_offset = 0
+        for i in range(0, len(tokens), chunk_size):
+            token_slice = tokens[i:i + chunk_size]
+            slice_bytes = b''.join(tokenizer.decode_single_token_bytes(token) for token in token_slice)
+
+            # A slice can end inside a multi-byte character; the decoder holds those
+            # bytes back until the next slice completes the character
+            piece_end = char_offset + len(decoder.decode(slice_bytes))
+            if piece_end > char_offset:
+                yield match.start() + char_offset, match.start() + piece_end, len(token_slice)
+                char_offset = piece_end
+
+def make_chunk(text, window, previous_word_end):
+    chunk_start = window[0][0]
+    chunk_end = window[-1][1]
+    return {
+        "chunk_text": text[chunk_start:chunk_end],
+        "chunk_start": chunk_start,
+        "chunk_end": chunk_end,
+        # Whitespace between the previous word and this chunk, so chunks that do not
+        # overlap can be joined back together exactly
+        "chunk_separator": text[previous_word_end:chunk_start]
+    }
+
+@lru_cache(maxsize=65536)
+def count_word_tokens(word):
+    # Words after the first are encoded with their leading space
+    return len(tokenizer.encode(' ' + word, disallowed_special=()))
+
+def count_tokens(text):
+    return len(tokenizer.encode(text, disallowed_special=()))
 
 def generate_embedding(text):
     #print("Function generate_embedding called")
     #print(f"Text input for embedding: {text[:100]}...")  # Print the first 100 characters of the text to avoid excessive output
 
     try:
+        # Return the cached embedding if this text was embedded before
+        cache_key = get_embedding_cache_key(text)
+        cached_embedding = embedding_cache.get(cache_key)
+        if cached_embedding is not None:
+            return decode_embedding(cached_embedding)
+
         # Make the call to OpenAI for embedding generation
         response = openai.Embedding.create(
             input=text,
@@ -73,9 +288,103 @@ def generate_embedding(text):
         # Extract embedding from the response
         embedding = response['data'][0]['embedding']
         #print(f"Embedding generated successfully: Length {len(embedding)}")
+
+        embedding_cache.set(cache_key, encode_embedding(embedding))
         return embedding
 
     except Exception as e:
         #print(f"Error in generating embedding: {str(e)}")
         return None
 
+def generate_query_embedding(query):
+    # Repeated and paged searches reuse the query's embedding from memory
+    embedding = query_embedding_cache.get(query)
+    if embedding is None:
+        embedding = generate_embedding(query)
+        if embedding is not None:
+            query_embedding_cache.set(query, embedding)
+    return embedding
+
+def generate_query_embeddings(queries):
+    # Serve repeated queries from memory and embed the rest in multi-input calls
+    embeddings = {query: query_embedding_cache.get(query) for query in dict.fromkeys(queries)}
+    missing = [query for query, embedding in embeddings.items() if embedding is None]
+    if missing:
+        for query, embedding in zip(missing, generate_embeddings(missing)):
+            query_embedding_cache.set(query, embedding)
+            embeddings[query] = embedding
+    return [embeddings[query] for query in queries]
+
+def get_cached_embeddings(texts):
+    # Only consults the embedding cache; texts that are not cached get None
+    cache_keys = [get_embedding_cache_key(text) for text in texts]
+    cached_embeddings = embedding_cache.get_many(cache_keys)
+    return [
+        decode_embedding(cached_embeddings[cache_key]) if cache_key in cached_embeddings else None
+        for cache_key in cache_keys
+    ]
+
+def generate_embeddings(texts):
+    # Look up every text in the embedding cache first
+    cache_keys = [get_embedding_cache_key(text) for text in texts]
+    cached_embeddings = embedding_cache.get_many(cache_keys)
+
+    # Only embed the distinct texts that are not cached yet
+    missing = {}
+    for cache_key, text in zip(cache_keys, texts):
+        if cache_key not in cached_embeddings:
+            missing[cache_key] = text
+    missing_keys = list(missing)
+    missing_texts = list(missing.values())
+
+    # Split the texts into multi-input batches
+    batches = [
+        missing_texts[i:i + AZURE_OPENAI_EMBEDDING_BATCH_SIZE]
+        for i in range(0, len(missing_texts), AZURE_OPENAI_EMBEDDING_BATCH_SIZE)
+    ]
+
+    # Embed several batches at once; map returns the results in batch order
+    with ThreadPoolExecutor(max_workers=AZURE_OPENAI_EMBEDDING_MAX_WORKERS) as executor:
+        batch_embeddings = list(executor.map(generate_embedding_batch, batches))
+
+    # Flatten the batches back into one embedding per missing text and cache them
+    new_embeddings = [embedding for batch in batch_embeddings for embedding in batch]
+    embedding_cache.set_many({
+        cache_key: encode_embedding(embedding)
+        for cache_key, embedding in zip(missing_keys, new_embeddings)
+    })
+
+    # Assemble one embedding per text, in input order
+    embeddings_by_key = dict(zip(missing_keys, new_embeddings))
+    for cache_key, value in cached_embeddings.items():
+        embeddings_by_key[cache_key] = decode_embedding(value)
+    return [embeddings_by_key[cache_key] for cache_key in cache_keys]
+
+def generate_embedding_batch(batch):
+    for attempt in range(AZURE_OPENAI_EMBEDDING_MAX_RETRIES + 1):
+        try:
+            # Make one multi-input call to OpenAI for the whole batch
+            response = openai.Embedding.create(
+                input=batch,
+                engine=AZURE_OPENAI_EMBEDDING_MODEL
+            )
+
+            # Order the embeddings by input index before returning them
+            data = sorted(response['data'], key=lambda item: item['index'])
+            return [item['embedding'] for item in data]
+
+        except Exception as e:
+            # Retry only this batch, backing off between attempts
+            if attempt == AZURE_OPENAI_EMBEDDING_MAX_RETRIES:
+                raise Exception(f"Error generating embeddings for batch: {str(e)}")
+            time.sleep(2 ** attempt)
+
+def get_embedding_cache_key(text):
+    # Hash the text together with the model so a model change never reuses old vectors
+    return hashlib.sha256(f"{AZURE_OPENAI_EMBEDDING_MODEL}\n{text}".encode('utf-8')).hexdigest()
+
+def encode_embedding(embedding):
+    return np.asarray(embedding, dtype=np.float32).tobytes()
+
+def decode_embedding(value):
+    return np.frombuffer(value, dtype=np.float32).tolist()
@@ -1,11 +1,24 @@
-from config import openai, conversations_container, exceptions, datetime
+from config import openai, conversations_container, conversation_turns_container, conversation_index_container, MatchConditions, exceptions, datetime, json, tokenizer, AZURE_OPENAI_LLM_MODEL, CHAT_CONTEXT_MAX_TOKENS, CHAT_SUMMARY_MAX_TOKENS, CHAT_SUMMARY_ENTRY_MAX_TOKENS, CHAT_SUMMARY_SLICE_MAX_TOKENS, CONVERSATION_CACHE_MAX_ENTRIES, CONVERSATION_CACHE_TTL_SECONDS, CONVERSATION_CACHE_MAX_BYTES, CONVERSATION_PREVIEW_MAX_CHARS
+from process_content import count_tokens
+from process_cache import MemoryCache
+
+#***************** Caches *****************
+# The turns of conversations this worker has loaded or written, as (created_at, thread, size).
+# Headers are always read from Cosmos DB; the cached turns are only used up to the
+# header's turn_count, and any turns appended since are read and added. Large file
+# extractions count against the byte limit, so a few long threads cannot fill memory.
+conversation_cache = MemoryCache(CONVERSATION_CACHE_MAX_ENTRIES, CONVERSATION_CACHE_TTL_SECONDS, CONVERSATION_CACHE_MAX_BYTES)
+
+#***************** Conversation Fields *****************
+# Fields of a turn item that make up its thread entry
+CONVERSATION_TURN_FIELDS = ["role", "content", "user_message", "assistant_reply", "timestamp"]
 
 #***************** Functions *****************
 # The functions support conversation management
 
 def get_conversation_history(conversation_id, user_id):
     try:
-        # Retrieve the conversation document using the conversation_id
+        # Retrieve the conversation header using the conversation_id; a single point read
         conversation_doc = conversations_container.read_item(
             item=conversation_id,
             partition_key=conversation_id  # Partition key is conversation_id
@@ -15,6 +28,10 @@ def get_conversation_history(conversation_id, user_id):
         if conversation_doc['user_id'] != user_id:
             #print(f"Unauthorized access attempt by user {user_id} on conversation {conversation_id}")
             return None  # Or raise an exception
+
+        # Conversations written before turns were stored separately still hold their thread
+        if 'thread' not in conversation_doc:
+            conversation_doc['thread'] = get_cached_conversation_turns(conversation_doc)
         
         return conversation_doc
     except exceptions.CosmosResourceNotFoundError:
@@ -23,77 +40,306 @@ def get_conversation_history(conversation_id, user_id):
         #print(f"Error retrieving conversation history: {str(e)}")
         return None
 
+def get_cached_conversation_turns(header):
+    # Reuse the cached turns of this conversation when the header still agrees with them,
+    # and read only the turns appended since they were cached
+    cached = conversation_cache.get(header['id'])
+    thread = []
+    size = 0
+    if cached is not None and cached[0] == header['created_at'] and len(cached[1]) <= header['turn_count']:
+        created_at, thread, size = cached
+
+    if len(thread) < header['turn_count']:
+        new_turns = get_conversation_turns(header['id'], start=len(thread))
+        thread = thread + new_turns
+        size += sum(get_entry_size(entry) for entry in new_turns)
+        conversation_cache.set(header['id'], (header['created_at'], thread, size), size)
+
+    # Hand out a copy so callers cannot change the cached thread
+    return list(thread)
+
+def get_entry_size(entry):
+    # Approximate memory held by a thread entry: the length of its texts
+    return sum(len(value) for value in entry.values() if isinstance(value, str))
+
+def get_conversation_turns(conversation_id, start=0):
+    # Every turn of a conversation shares one partition, so this is a single-partition query
+    query = """
+        SELECT * FROM c
+        WHERE c.conversation_id = @conversation_id AND c.sequence >= @start
+        ORDER BY c.sequence
+    """
+    parameters = [
+        {"name": "@conversation_id", "value": conversation_id},
+        {"name": "@start", "value": start}
+    ]
 
-def list_conversations(user_id):
+    items = conversation_turns_container.query_items(
+        query=query,
+        parameters=parameters,
+        partition_key=conversation_id
+    )
+    return [{key: item[key] for key in CONVERSATION_TURN_FIELDS if key in item} for item in items]
+
+
+def list_conversations(user_id, page_size=None, continuation_token=None):
+    # Returns one page of the user's conversations, most recently updated first, and the
+    # token for the next page. Without a page size every conversation is returned.
     try:
-        # Query to fetch all conversations with the last message for the given user_id
+        ensure_conversation_index(user_id)
+
+        # The index is partitioned by user_id, so this query stays in one partition
         query = """
-            SELECT c.id, c.created_at, c.updated_at, 
-            ARRAY_SLICE(c.thread, -1)[0] AS last_message
-            FROM c WHERE c.user_id = @user_id
+            SELECT c.id, c.title, c.created_at, c.updated_at, c.last_message
+            FROM c WHERE c.user_id = @user_id AND c.type = 'conversation'
+            ORDER BY c.updated_at DESC
         """
         parameters = [
             {"name": "@user_id", "value": user_id}
         ]
-        
-        # Perform the query on the container
-        items = list(conversations_container.query_items(
+
+        items = conversation_index_container.query_items(
             query=query,
             parameters=parameters,
-            enable_cross_partition_query=True
-        ))
-        
-        return items
+            partition_key=user_id,
+            max_item_count=page_size
+        )
+        if page_size is None:
+            return list(items), None
+
+        pages = items.by_page(continuation_token)
+        page = list(next(pages, []))
+        return page, pages.continuation_token
+    except exceptions.CosmosHttpResponseError as e:
+        if continuation_token and e.status_code == 400:
+            raise ValueError('Invalid continuation_token')
+        #print(f"Error fetching conversations: {str(e)}")
+        return [], None
     except Exception as e:
         #print(f"Error fetching conversations: {str(e)}")
-        return []
+        return [], None
 
-def update_conversation_thread(conversation_id, user_id, user_message, assistant_reply):
+def ensure_conversation_index(user_id):
+    # Conversations created before the index existed are added to it the first time
+    # the user lists them; create_item never replaces an entry an append already wrote
+    state_id = f"{user_id}_index_state"
     try:
-        # Try to retrieve the conversation document
-        conversation_doc = conversations_container.read_item(
-            item=conversation_id,
-            partition_key=conversation_id
-        )
-        
-        # Verify that the user_id matches
-        if conversation_doc['user_id'] != user_id:
-            #print(f"Unauthorized update attempt by user {user_id} on conversation {conversation_id}")
-            raise Exception("Unauthorized access")
-        
-        # Append the new user message and assistant reply to the conversation thread
-        conversation_doc['thread'].append({
+        conversation_index_container.read_item(item=state_id, partition_key=user_id)
+        return
+    except exceptions.CosmosResourceNotFoundError:
+        pass
+
+    query = """
+        SELECT c.id, c.user_id, c.title, c.created_at, c.updated_at,
+        c.last_message ?? ARRAY_SLICE(c.thread, -1)[0] AS last_message,
+        ARRAY_SLICE(c.thread, 0, 1)[0] AS first_message
+        FROM c WHERE c.user_id = @user_id
+    """
+    headers = conversations_container.query_items(
+        query=query,
+        parameters=[{"name": "@user_id", "value": user_id}],
+        enable_cross_partition_query=True
+    )
+    for header in headers:
+        if not header.get('title') and header.get('first_message'):
+            header['title'] = get_conversation_title(header['first_message'])
+        try:
+            conversation_index_container.create_item(get_conversation_index_item(header))
+        except exceptions.CosmosResourceExistsError:
+            pass
+
+    conversation_index_container.upsert_item({
+        "id": state_id,
+        "user_id": user_id,
+        "type": "index_state",
+        "indexed_at": datetime.utcnow().isoformat()
+    })
+
+def get_conversation_index_item(header):
+    # The index entry holds just enough to list a conversation
+    last_message = header.get('last_message')
+    if last_message:
+        last_message = get_message_preview(last_message)
+    return {
+        "id": header['id'],
+        "user_id": header['user_id'],
+        "type": "conversation",
+        "title": header.get('title'),
+        "created_at": header.get('created_at'),
+        "updated_at": header.get('updated_at'),
+        "last_message": last_message
+    }
+
+def get_message_preview(entry):
+    # A thread entry with its texts cut short, small enough to keep in headers and the index
+    return {
+        key: truncate_preview(value) if key != 'timestamp' else value
+        for key, value in entry.items() if key in CONVERSATION_TURN_FIELDS
+    }
+
+def get_conversation_title(entry):
+    # Conversations are titled after their first user message, or their first system message
+    return truncate_preview(entry.get('user_message') or entry.get('content'))
+
+def truncate_preview(text):
+    if not isinstance(text, str) or len(text) <= CONVERSATION_PREVIEW_MAX_CHARS:
+        return text
+    return text[:CONVERSATION_PREVIEW_MAX_CHARS].rstrip() + '...'
+
+def update_conversation_index(header):
+    # The turn is already stored, so a failed index write only leaves the list behind
+    try:
+        conversation_index_container.upsert_item(get_conversation_index_item(header))
+    except Exception as e:
+        print(f"Error updating conversation index: {str(e)}")
+
+def update_conversation_thread(conversation_id, user_id, user_message, assistant_reply, summary=None, conversation_doc=None):
+    try:
+        # Append the new user message and assistant reply, starting the conversation if it is new
+        append_conversation_turn(conversation_id, user_id, {
             "user_message": user_message,
             "assistant_reply": assistant_reply,
             "timestamp": datetime.utcnow().isoformat()
-        })
-        conversation_doc['updated_at'] = datetime.utcnow().isoformat()
-        
-        # Upsert the document in Cosmos DB with the updated thread
-        conversations_container.upsert_item(conversation_doc)
-
-    except exceptions.CosmosResourceNotFoundError:
-        # If the document doesn't exist, create a new one
-        conversation_doc = {
-            "id": conversation_id,
-            "user_id": user_id,
-            "thread": [{
-                "user_message": user_message,
-                "assistant_reply": assistant_reply,
-                "timestamp": datetime.utcnow().isoformat()
-            }],
-            "created_at": datetime.utcnow().isoformat(),
-            "updated_at": datetime.utcnow().isoformat()
-        }
-        # Upsert the new document in Cosmos DB
-        conversations_container.upsert_item(conversation_doc)
+        }, summary=summary, create=True, conversation_doc=conversation_doc)
 
     except Exception as e:
         print(f"Error updating conversation thread: {str(e)}")
 
+def append_conversation_turn(conversation_id, user_id, entry, summary=None, create=False, conversation_doc=None):
+    # Each turn is its own item, so an append writes one new item and rewrites only
+    # the small header, however long the conversation already is. The header the
+    # request already loaded is reused, and is only read again when its ETag is stale.
+    header = get_conversation_header(conversation_id, conversation_doc)
+    while True:
+        if header is None:
+            if not create:
+                raise exceptions.CosmosResourceNotFoundError(message=f"Conversation {conversation_id} not found")
+            try:
+                now = datetime.utcnow().isoformat()
+                header = conversations_container.create_item({
+                    "id": conversation_id,
+                    "user_id": user_id,
+                    "turn_count": 0,
+                    "created_at": now,
+                    "updated_at": now
+                })
+            except exceptions.CosmosResourceExistsError:
+                header = read_conversation_header(conversation_id)
+            continue
+
+        # Verify that the user_id matches
+        if header['user_id'] != user_id:
+            #print(f"Unauthorized update attempt by user {user_id} on conversation {conversation_id}")
+            raise Exception("Unauthorized access")
+
+        if 'turn_count' not in header:
+            migrate_conversation(header)
+            header = read_conversation_header(conversation_id)
+            continue
+        break
+
+    # Claim the next sequence number; a conflict means a concurrent append took it first
+    sequence = header['turn_count']
+    while True:
+        try:
+            conversation_turns_container.create_item(dict(entry,
+                id=get_conversation_turn_id(conversation_id, sequence),
+                conversation_id=conversation_id,
+                user_id=user_id,
+                sequence=sequence
+            ))
+            break
+        except exceptions.CosmosResourceExistsError:
+            sequence += 1
+
+    # Update the header with an ETag check so concurrent appends are never lost
+    while True:
+        header['turn_count'] = max(header['turn_count'], sequence + 1)
+        header['updated_at'] = datetime.utcnow().isoformat()
+        if header['turn_count'] == sequence + 1:
+            header['last_message'] = get_message_preview(entry)
+        if not header.get('title') and entry.get('user_message'):
+            header['title'] = get_conversation_title(entry)
+
+        # Store the rolling summary of the older turns when it was refreshed
+        if summary is not None and summary['entries'] > (header.get('summary') or {}).get('entries', 0):
+            header['summary'] = summary
+
+        try:
+            header = conversations_container.replace_item(
+                item=conversation_id,
+                body=header,
+                etag=header['_etag'],
+                match_condition=MatchConditions.IfNotModified
+            )
+            break
+        except exceptions.CosmosAccessConditionFailedError:
+            header = read_conversation_header(conversation_id)
+
+    update_conversation_index(header)
+
+    # Write through to the cache when it holds every turn before this one, otherwise
+    # drop it so the next read loads the turns another worker appended
+    cached = conversation_cache.get(conversation_id)
+    created_at, thread, size = cached if cached is not None and cached[0] == header['created_at'] else (None, [], 0)
+    if len(thread) == sequence and header['turn_count'] == sequence + 1:
+        size += get_entry_size(entry)
+        conversation_cache.set(conversation_id, (header['created_at'], thread + [entry], size), size)
+    else:
+        conversation_cache.delete(conversation_id)
+
+    return sequence
+
+def get_conversation_header(conversation_id, conversation_doc=None):
+    # Prefer the conversation the request loaded, then Cosmos DB
+    if conversation_doc is None:
+        return read_conversation_header(conversation_id)
+
+    # Conversations stored as a single document keep their thread in the header
+    if 'turn_count' not in conversation_doc:
+        return dict(conversation_doc)
+    return {key: value for key, value in conversation_doc.items() if key != 'thread'}
+
+def read_conversation_header(conversation_id):
+    try:
+        return conversations_container.read_item(item=conversation_id, partition_key=conversation_id)
+    except exceptions.CosmosResourceNotFoundError:
+        return None
+
+def get_conversation_turn_id(conversation_id, sequence):
+    return f"{conversation_id}_{sequence:08d}"
+
+def migrate_conversation(header):
+    # Move the thread of a conversation stored as a single document into turn items.
+    # Turn ids are deterministic, so a migration that was interrupted is simply repeated.
+    thread = header.pop('thread')
+    for sequence, entry in enumerate(thread):
+        conversation_turns_container.upsert_item(dict(entry,
+            id=get_conversation_turn_id(header['id'], sequence),
+            conversation_id=header['id'],
+            user_id=header['user_id'],
+            sequence=sequence
+        ))
+
+    header['turn_count'] = len(thread)
+    if thread:
+        header['last_message'] = get_message_preview(thread[-1])
+
+    try:
+        conversations_container.replace_item(
+            item=header['id'],
+            body=header,
+            etag=header['_etag'],
+            match_condition=MatchConditions.IfNotModified
+        )
+    except exceptions.CosmosAccessConditionFailedError:
+        # Another request changed the conversation first; the caller re-reads it
+        pass
+    conversation_cache.delete(header['id'])
+
 def delete_conversation_thread(conversation_id, user_id):
     try:
-        # Retrieve the conversation document
+        # Retrieve the conversation header
         conversation_doc = conversations_container.read_item(
             item=conversation_id,
             partition_key=conversation_id
@@ -104,11 +350,29 @@ def delete_conversation_thread(conversation_id, user_id):
             #print(f"Unauthorized delete attempt by user {user_id} on conversation {conversation_id}")
             raise Exception("Unauthorized access")
 
-        # Delete the conversation document
+        conversation_cache.delete(conversation_id)
+
+        # Delete the turns first, so a failed delete leaves a conversation that can be deleted again
+        turns = conversation_turns_container.query_items(
+            query="SELECT c.id FROM c WHERE c.conversation_id = @conversation_id",
+            parameters=[{"name": "@conversation_id", "value": conversation_id}],
+            partition_key=conversation_id
+        )
+        for turn in list(turns):
+            try:
+                conversation_turns_container.delete_item(item=turn['id'], partition_key=conversation_id)
+            except exceptions.CosmosResourceNotFoundError:
+                pass
+
+        # Delete the conversation header, then its entry in the user's index
         conversations_container.delete_item(
             item=conversation_id,
             partition_key=conversation_id
         )
+        try:
+            conversation_index_container.delete_item(item=conversation_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            pass
 
         return True
 
@@ -119,29 +383,14 @@ def delete_conversation_thread(conversation_id, user_id):
         #print(f"Error deleting conversation: {str(e)}")
         raise e
 
-def add_system_message_to_conversation(conversation_id, user_id, content):
+def add_system_message_to_conversation(conversation_id, user_id, content, conversation_doc=None):
     try:
-        # Retrieve the conversation document
-        conversation_doc = conversations_container.read_item(
-            item=conversation_id,
-            partition_key=conversation_id
-        )
-
-        # Verify that the user_id matches
-        if conversation_doc['user_id'] != user_id:
-            #print(f"Unauthorized access attempt by user {user_id} on conversation {conversation_id}")
-            raise Exception("Unauthorized access")
-
         # Append the system message
-        conversation_doc['thread'].append({
+        append_conversation_turn(conversation_id, user_id, {
             "role": "system",
             "content": content,
             "timestamp": datetime.utcnow().isoformat()
-        })
-        conversation_doc['updated_at'] = datetime.utcnow().isoformat()
-
-        # Upsert the document
-        conversations_container.upsert_item(conversation_doc)
+        }, conversation_doc=conversation_doc)
 
     except exceptions.CosmosResourceNotFoundError:
         # Conversation doesn't exist
@@ -149,4 +398,128 @@ def add_system_message_to_conversation(conversation_id, user_id, content):
         raise Exception("Conversation not found")
     except Exception as e:
         #print(f"Error adding system message to conversation: {str(e)}")
-        raise e
\ No newline at end of file
+        raise e
+
+def format_sse_event(event, data):
+    # One Server-Sent Event; the data is a single line of JSON
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def get_entry_messages(entry):
+    # A thread entry is either an injected system message or a user/assistant turn
+    if entry.get('role') == 'system':
+        return [{"role": "system", "content": entry['content']}]
+    return [
+        {"role": "user", "content": entry['user_message']},
+        {"role": "assistant", "content": entry['assistant_reply']}
+    ]
+
+def count_message_tokens(messages):
+    # Each message also costs a few tokens for its role and separators
+    return sum(count_tokens(message['content']) + 4 for message in messages)
+
+def build_chat_context(conversation_history, reserved_tokens=0):
+    # Returns the messages to replay and, when it had to be refreshed, the new summary.
+    # Recent entries are kept verbatim, newest first, while they fit in the budget;
+    # everything older is represented by a rolling summary stored on the conversation.
+    if not conversation_history:
+        return [], None
+
+    thread = conversation_history['thread']
+    summary = conversation_history.get('summary') or {"content": "", "entries": 0}
+    budget = CHAT_CONTEXT_MAX_TOKENS - reserved_tokens - CHAT_SUMMARY_MAX_TOKENS
+
+    # Walk back from the newest entry until the budget is spent; entries the
+    # summary already covers never need to be counted again
+    start = len(thread)
+    used_tokens = 0
+    while start > summary['entries']:
+        entry_tokens = count_message_tokens(get_entry_messages(thread[start - 1]))
+        if used_tokens + entry_tokens > budget:
+            break
+        used_tokens += entry_tokens
+        start -= 1
+
+    # The newest entry is kept even when it alone is over the budget, such as a large
+    # file, cut down to fit rather than left to the summary
+    recent_entries = thread[start:]
+    if start == len(thread) and start > summary['entries'] and budget > 0:
+        start -= 1
+        recent_entries = [truncate_entry(thread[start], budget)]
+
+    # Fold only the entries that have newly fallen out of the window into the summary,
+    # a bounded slice at a time, so a long conversation summarized for the first time
+    # never overflows one request. If a slice fails, the entries not yet folded are
+    # left out this time and folded in on a later turn.
+    refreshed_summary = None
+    while summary['entries'] < start:
+        slice_end = get_summary_slice_end(thread, summary['entries'], start)
+        try:
+            content = summarize_conversation(summary['content'], thread[summary['entries']:slice_end])
+        except Exception as e:
+            #print(f"Error summarizing conversation: {str(e)}")
+            break
+        refreshed_summary = {"content": content, "entries": slice_end}
+        summary = refreshed_summary
+
+    messages = []
+    if summary['content']:
+        messages.append({"role": "system", "content": f"Summary of the earlier conversation:\n{summary['content']}"})
+    for entry in recent_entries:
+        messages.extend(get_entry_messages(entry))
+
+    return messages, refreshed_summary
+
+def get_summary_slice_end(thread, begin, end):
+    # Take entries until the next one would push the slice past CHAT_SUMMARY_SLICE_MAX_TOKENS,
+    # counting each message as summarize_conversation will send it
+    slice_end = begin
+    slice_tokens = 0
+    while slice_end < end:
+        entry_tokens = sum(
+            min(count_tokens(message['content']), CHAT_SUMMARY_ENTRY_MAX_TOKENS) + 4
+            for message in get_entry_messages(thread[slice_end])
+        )
+        if slice_end > begin and slice_tokens + entry_tokens > CHAT_SUMMARY_SLICE_MAX_TOKENS:
+            break
+        slice_tokens += entry_tokens
+        slice_end += 1
+    return slice_end
+
+def truncate_entry(entry, max_tokens):
+    # Share max_tokens between the entry's texts; a text shorter than its share
+    # leaves the rest to the others
+    fields = ['content'] if entry.get('role') == 'system' else ['user_message', 'assistant_reply']
+    remaining = max_tokens - 4 * len(fields)
+    truncated = dict(entry)
+    for i, field in enumerate(sorted(fields, key=lambda field: count_tokens(entry[field]))):
+        share = max(remaining // (len(fields) - i), 0)
+        truncated[field] = truncate_text(entry[field], share)
+        remaining -= count_tokens(truncated[field])
+    return truncated
+
+def truncate_text(text, max_tokens):
+    tokens = tokenizer.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return tokenizer.decode(tokens[:max_tokens])
+
+def summarize_conversation(previous_summary, entries):
+    # Cap each entry so a large file or search result cannot overflow the summary request
+    lines = []
+    for entry in entries:
+        for message in get_entry_messages(entry):
+            lines.append(f"{message['role']}: {truncate_text(message['content'], CHAT_SUMMARY_ENTRY_MAX_TOKENS)}")
+
+    prompt = (
+        "Update the summary of a conversation with the new messages below. Keep facts, decisions, "
+        "names, numbers and open questions that later messages may refer to.\n\n"
+        f"Current summary:\n{previous_summary or '(none)'}\n\n"
+        "New messages:\n" + "\n\n".join(lines)
+    )
+
+    response = openai.ChatCompletion.create(
+        engine=AZURE_OPENAI_LLM_MODEL,
+        messages=[{"role": "user", "content": prompt}],
+        max_tokens=CHAT_SUMMARY_MAX_TOKENS
+    )
+    return response['choices'][0]['message']['content']
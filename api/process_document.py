@@ -1,5 +1,30 @@
-from config import openai, documents_container, jsonify, request, secure_filename, os, tempfile, json, uuid, datetime, timezone, search_client_user, VectorizedQuery
-from process_content import extract_text_file, extract_markdown_file, extract_content_with_azure_di, chunk_text, generate_embedding
+from config import openai, documents_container, jsonify, request, secure_filename, os, tempfile, json, uuid, datetime, timezone, search_client_user, VectorizedQuery, INGESTION_WINDOW_CHUNKS, itertools, JOB_STAGING_DIR, JOB_STAGING_MIN_BYTES, AZURE_DOCUMENT_INTELLIGENCE_FILE_EXTENSIONS, io, NEXUS_SEARCH_BACKEND, exceptions, MatchConditions, SEARCH_RESULT_CACHE_MAX_ENTRIES, SEARCH_RESULT_CACHE_TTL_SECONDS, SEARCH_RESULT_CACHE_SETTLE_SECONDS, time, base64, hashlib, ThreadPoolExecutor, AZURE_AI_SEARCH_MAX_WORKERS, SEARCH_RERANK_CANDIDATE_MULTIPLIER, CHUNK_EXPORT_PAGE_SIZE, search_client_group, wait, SEARCH_SOURCE_TIMEOUT_SECONDS
+from process_content import extract_file_text, chunk_text, generate_embedding, generate_embeddings, generate_query_embedding, generate_query_embeddings, get_cached_embeddings
+from process_jobs import create_job, update_job, submit_job, resume_jobs
+from process_search import write_user_chunks, get_failed_search_documents
+from process_vector_index import search_local_index, find_local_index_documents
+from process_cache import MemoryCache
+from process_rerank import mmr_rerank, mmr_rerank_by_text, merge_adjacent_chunks, reciprocal_rank_fusion
+
+#***************** Caches *****************
+# Search results per (user, generation, query, top_n); a new generation makes older entries unreachable
+search_result_cache = MemoryCache(SEARCH_RESULT_CACHE_MAX_ENTRIES, SEARCH_RESULT_CACHE_TTL_SECONDS)
+
+#***************** Workers *****************
+# Shared pool for federated searches; a source that overruns its budget finishes here without holding up the response
+search_executor = ThreadPoolExecutor(max_workers=AZURE_AI_SEARCH_MAX_WORKERS * 4)
+
+#***************** Search Fields *****************
+# Fields returned for each chunk by default, and for clients that only need ids and scores
+SEARCH_RESULT_FIELDS = ["id", "chunk_text", "chunk_id", "file_name", "user_id", "version", "chunk_sequence", "upload_date"]
+SEARCH_RESULT_ID_FIELDS = ["id"]
+# Re-ranking also needs to know where each chunk sits in its document
+SEARCH_RERANK_FIELDS = SEARCH_RESULT_FIELDS + ["document_id", "chunk_start", "chunk_end"]
+# Group index chunks belong to a group rather than a user
+SEARCH_GROUP_RESULT_FIELDS = ["id", "chunk_text", "chunk_id", "file_name", "group_id", "version", "chunk_sequence", "upload_date"]
+# Fields walked when exporting a document's chunks in order
+CHUNK_EXPORT_FIELDS = ["id", "chunk_text", "chunk_id", "version", "chunk_sequence", "chunk_start", "chunk_end", "chunk_separator"]
+CHUNK_EXPORT_FORMATS = ["json", "ndjson", "text"]
 
 #***************** Functions *****************
 # The functions support document management
@@ -10,7 +35,8 @@ def get_user_documents(user_id):
         query = """
             SELECT c.file_name, c.id, c.upload_date, c.user_id, c.version
             FROM c
-            WHERE c.user_id = @user_id
+            WHERE c.user_id = @user_id AND c.type = 'document_metadata'
+            AND (NOT IS_DEFINED(c.status) OR c.status = 'indexed')
         """
         parameters = [{"name": "@user_id", "value": user_id}]
         
@@ -47,72 +73,159 @@ def upload_user_document(user_id):
     file_ext = os.path.splitext(filename)[1].lower()
     #print(f"File extension: {file_ext}")
 
-    # Save the file to a temporary location
-    with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
-        file.save(tmp_file.name)
-        temp_file_path = tmp_file.name
-    #print(f"Temporary file path: {temp_file_path}")
+    if file_ext not in AZURE_DOCUMENT_INTELLIGENCE_FILE_EXTENSIONS + ['.txt', '.md', '.json']:
+        #print("Unsupported file type")
+        return jsonify({'error': 'Unsupported file type'}), 400
 
-    extracted_text = ''
+    staged_file_path = None
+    try:
+        job_id = str(uuid.uuid4())
+
+        # Measure the spooled upload without reading it
+        file.stream.seek(0, os.SEEK_END)
+        file_size = file.stream.tell()
+        file.stream.seek(0)
+
+        if file_size > JOB_STAGING_MIN_BYTES:
+            # Stage large files where the background worker (and a restarted process) can find them
+            os.makedirs(JOB_STAGING_DIR, exist_ok=True)
+            staged_file_path = os.path.join(JOB_STAGING_DIR, f"{job_id}{file_ext}")
+            file.save(staged_file_path)
+            file_content = None
+            #print(f"Staged file path: {staged_file_path}")
+        else:
+            # Hand small files to the worker in memory; a restart fails these jobs instead of resuming them
+            staged_file_path = None
+            file_content = file.stream.read()
+
+        # Persist the job and hand it to the background worker pool
+        job = create_job(
+            user_id,
+            'document_ingestion',
+            job_id=job_id,
+            file_name=filename,
+            file_ext=file_ext,
+            document_id=str(uuid.uuid4()),
+            staged_file_path=staged_file_path
+        )
+
+        # Capture the response before the worker starts updating the job
+        response_data = {
+            'message': 'Document accepted for processing',
+            'file_name': filename,
+            'job_id': job['id'],
+            'document_id': job['document_id'],
+            'status': job['status']
+        }
+        submit_job(job, run_ingestion_job, file_content)
+
+    except Exception as e:
+        #print(f"Error queuing file: {str(e)}")
+        # No job owns the staged file, so remove it here
+        if staged_file_path and os.path.exists(staged_file_path):
+            os.remove(staged_file_path)
+        return jsonify({'error': f'Error queuing file: {str(e)}'}), 500
+
+    #print(f"Response data: {response_data}")
+    return jsonify(response_data), 202
 
+def run_ingestion_job(job, file_content=None):
     try:
-        # Use existing extraction functions
-        if file_ext in ['.pdf', '.docx', '.xlsx', '.pptx', '.html',
-                        '.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif', '.heif']:
-            #print("Extracting content using Azure DI")
-            extracted_text = extract_content_with_azure_di(temp_file_path)
-        elif file_ext == '.txt':
-            #print("Extracting text from .txt file")
-            extracted_text = extract_text_file(temp_file_path)
-        elif file_ext == '.md':
-            #print("Extracting text from .md file")
-            extracted_text = extract_markdown_file(temp_file_path)
-        elif file_ext == '.json':
-            #print("Processing JSON file")
-            with open(temp_file_path, 'r', encoding='utf-8') as f:
-                parsed_json = json.load(f)
-                extracted_text = json.dumps(parsed_json)
+        update_job(job, status='extracting')
+        if file_content is not None:
+            file = io.BytesIO(file_content)
         else:
-            #print("Unsupported file type")
-            return jsonify({'error': 'Unsupported file type'}), 400
+            file = open(job['staged_file_path'], 'rb')
+        with file:
+            extracted_text = extract_file_text(file, job['file_ext'])
+
+        # Report each chunking, embedding and indexing step on the job
+        def report_progress(stage, chunks_processed):
+            update_job(job, status=stage, chunks_processed=chunks_processed)
 
         # Process the extracted text and store chunks in 'documents' container
-        #print(f"Processing and storing extracted text for file: {filename}")
-        process_document_and_store_chunks(extracted_text, filename, user_id)
+        #print(f"Processing and storing extracted text for file: {job['file_name']}")
+        indexing_summary = process_document_and_store_chunks(
+            extracted_text,
+            job['file_name'],
+            job['user_id'],
+            document_id=job['document_id'],
+            progress_callback=report_progress
+        )
+
+        failed_chunks = indexing_summary['failed_chunks']
+        if failed_chunks:
+            update_job(
+                job,
+                status='failed',
+                chunks_processed=indexing_summary['chunks_indexed'],
+                failed_chunks=failed_chunks,
+                error=f'{len(failed_chunks)} chunks could not be indexed'
+            )
+        else:
+            update_job(job, status='done', chunks_processed=indexing_summary['chunks_indexed'])
 
     except Exception as e:
         #print(f"Error processing file: {str(e)}")
-        return jsonify({'error': f'Error processing file: {str(e)}'}), 500
+        update_job(job, status='failed', error=f'Error processing file: {str(e)}')
+        mark_document_failed(job['user_id'], job['document_id'])
     finally:
-        # Ensure the temp file is removed
-        #print(f"Removing temporary file: {temp_file_path}")
-        os.remove(temp_file_path)
-
-    response_data = {
-        'message': 'Document uploaded and processed successfully',
-        'file_name': filename
-    }
+        # Ensure the staged file is removed once the job has finished
+        if job.get('staged_file_path') and os.path.exists(job['staged_file_path']):
+            os.remove(job['staged_file_path'])
+
+def start_deletion_job(user_id, document_id, chunk_count=None, version=None):
+    # Remove a document's chunks in the background; progress is read through the jobs endpoint
+    job = create_job(user_id, 'document_deletion', document_id=document_id, chunk_count=chunk_count, version=version)
+    response_data = {"job_id": job['id'], "document_id": document_id, "status": job['status']}
+    submit_job(job, run_deletion_job)
+    return response_data
+
+def run_deletion_job(job):
+    try:
+        update_job(job, status='deleting')
+        if job.get('version') is not None:
+            chunks_deleted = delete_user_document_version_chunks(job['document_id'], job['version'], job['user_id'], job.get('chunk_count'))
+        else:
+            chunks_deleted = delete_user_document_chunks(job['document_id'], job['user_id'], job.get('chunk_count'))
+        update_job(job, status='done', chunks_processed=chunks_deleted)
 
-    #print(f"Response data: {response_data}")
-    return jsonify(response_data), 200
+    except Exception as e:
+        update_job(job, status='failed', error=f'Error deleting chunks: {str(e)}')
+
+def resume_deletion_jobs():
+    # Deleting by key is idempotent, so an interrupted deletion can always start over
+    resume_jobs('document_deletion', run_deletion_job, lambda job: True)
+
+def resume_ingestion_jobs():
+    # Jobs can only be resumed if they were staged on disk and the file survived the restart
+    resume_jobs(
+        'document_ingestion',
+        run_ingestion_job,
+        lambda job: bool(job.get('staged_file_path')) and os.path.exists(job['staged_file_path'])
+    )
 
 
-def process_document_and_store_chunks(extracted_text, file_name, user_id):
+def process_document_and_store_chunks(extracted_text, file_name, user_id, document_id=None, progress_callback=None):
     #print("Function process_document_and_store_chunks called")
-    document_id = str(uuid.uuid4())  # Unique ID for the document
+    # Unique ID for the document; a resumed job passes its own so chunks are overwritten, not duplicated
+    document_id = document_id or str(uuid.uuid4())
     #print(f"Generated document ID: {document_id}")
     
-    # Chunk the extracted text
+    # Chunk the extracted text lazily; chunks are consumed window by window below
     chunks = chunk_text(extracted_text)
-    #print(f"Total chunks created: {len(chunks)}")
 
     # Check if there's an existing version of this document
     existing_document_query = """
         SELECT c.version 
         FROM c 
-        WHERE c.file_name = @file_name AND c.user_id = @user_id
+        WHERE c.file_name = @file_name AND c.user_id = @user_id AND c.id != @document_id
     """
-    parameters = [{"name": "@file_name", "value": file_name}, {"name": "@user_id", "value": user_id}]
+    parameters = [
+        {"name": "@file_name", "value": file_name},
+        {"name": "@user_id", "value": user_id},
+        {"name": "@document_id", "value": document_id}
+    ]
     #print(f"Querying existing document with parameters: {parameters}")
     
     existing_document = list(documents_container.query_items(query=existing_document_query, parameters=parameters, enable_cross_partition_query=True))
@@ -120,7 +233,7 @@ def process_document_and_store_chunks(extracted_text, file_name, user_id):
 
     # Determine the new version number
     if existing_document:
-        version = existing_document[0]['version'] + 1
+        version = max(doc['version'] for doc in existing_document) + 1
         #print(f"New version determined: {version} (existing document found)")
     else:
         version = 1
@@ -139,42 +252,91 @@ def process_document_and_store_chunks(extracted_text, file_name, user_id):
         "user_id": user_id,
         "upload_date": formatted_time,
         "version": version,
-        "type": "document_metadata"
+        "type": "document_metadata",
+        "is_current": False,
+        "status": "indexing"  # only indexed uploads are listed or promoted
     }
     #print(f"Document metadata to be upserted: {document_metadata}")
     documents_container.upsert_item(document_metadata)
 
-    chunk_documents = []
-    
-    # Process each chunk
-    for idx, chunk_text_content in enumerate(chunks):
-        chunk_id = f"{document_id}_{idx}"  # Create a unique chunk ID
-        #print(f"Processing chunk {idx} with ID: {chunk_id}")
-
-        # Generate embedding
-        embedding = generate_embedding(chunk_text_content)
-        #print(f"Generated embedding for chunk {idx}")
-
-        # Create chunk document with versioning
-        chunk_document = {
-            "id": chunk_id,
-            "document_id": document_id,
-            "chunk_id": str(idx),
-            "chunk_text": chunk_text_content,
-            "embedding": embedding,
-            "file_name": file_name,
-            "user_id": user_id,
-            "chunk_sequence": idx,
-            "upload_date": formatted_time,
-            "version": version
-        }
-        #print(f"Chunk document created for chunk {idx}: {chunk_document}")
-        chunk_documents.append(chunk_document)
+    idx = 0
+    chunks_indexed = 0
+    failed_chunks = []
+
+    # Stream the chunks through embedding and indexing one window at a time
+    while True:
+        if progress_callback:
+            progress_callback('chunking', chunks_indexed)
+
+        window = list(itertools.islice(chunks, INGESTION_WINDOW_CHUNKS))
+        if not window:
+            break
+
+        # Generate embeddings for the window in concurrent multi-input batches
+        if progress_callback:
+            progress_callback('embedding', chunks_indexed)
+        embeddings = generate_embeddings([chunk['chunk_text'] for chunk in window])
+        #print(f"Generated {len(embeddings)} embeddings")
+
+        chunk_documents = []
+
+        # Process each chunk
+        for chunk, embedding in zip(window, embeddings):
+            chunk_id = f"{document_id}_{idx}"  # Create a unique chunk ID
+            #print(f"Processing chunk {idx} with ID: {chunk_id}")
+
+            # Create chunk document with versioning
+            chunk_document = {
+                "id": chunk_id,
+                "document_id": document_id,
+                "chunk_id": str(idx),
+                "chunk_text": chunk['chunk_text'],
+                "chunk_start": chunk['chunk_start'],
+                "chunk_end": chunk['chunk_end'],
+                "chunk_separator": chunk['chunk_separator'],
+                "embedding": embedding,
+                "file_name": file_name,
+                "user_id": user_id,
+                "chunk_sequence": idx,
+                "upload_date": formatted_time,
+                "version": version,
+                "is_current": False  # becomes current once every chunk is indexed
+            }
+            #print(f"Chunk document created for chunk {idx}: {chunk_document}")
+            chunk_documents.append(chunk_document)
+            idx += 1
+
+        # Upload the window's chunk documents to the search backend
+        if progress_callback:
+            progress_callback('indexing', chunks_indexed)
+        #print(f"Uploading {len(chunk_documents)} chunk documents to the search backend")
+        indexing_results = write_user_chunks(user_id, chunk_documents)
+        window_failed_chunks = get_failed_search_documents(indexing_results)
+        failed_chunks.extend(window_failed_chunks)
+        chunks_indexed += len(chunk_documents) - len(window_failed_chunks)
+        #print("Chunks uploaded successfully")
+
+    # Record how many chunks were written; their ids follow from it, so deletes need no search.
+    # A partly indexed upload is marked failed so it is never listed or promoted.
+    document_metadata['chunk_count'] = idx
+    document_metadata['status'] = 'failed' if failed_chunks else 'indexed'
+    documents_container.upsert_item(document_metadata)
+
+    # Once every chunk is indexed, make this upload current and retire earlier versions.
+    # A partly indexed upload stays hidden and the previous version stays current.
+    if not failed_chunks:
+        set_current_version(user_id, file_name, document_id, idx)
+
+    # Invalidate the user's cached search results now that the new chunks are searchable
+    bump_search_generation(user_id)
+
+    # Report the per-chunk indexing outcome back to the caller
+    return {
+        "document_id": document_id,
+        "chunks_indexed": chunks_indexed,
+        "failed_chunks": failed_chunks
+    }
 
-    # Upload the chunk documents to Azure Cognitive Search
-    #print(f"Uploading {len(chunk_documents)} chunk documents to Azure Cognitive Search")
-    search_client_user.upload_documents(documents=chunk_documents)
-    #print("Chunks uploaded successfully")
 
 def get_user_document(user_id, document_id):
     #print(f"Function get_user_document called for user_id: {user_id}, document_id: {document_id}")
@@ -277,7 +439,7 @@ def get_user_document_version(user_id, document_id, version):
 def delete_user_document(user_id, document_id):
     # Query to find all versions of the document by user_id
     query = """
-        SELECT c.id 
+        SELECT c.id, c.user_id
         FROM c 
         WHERE c.id = @document_id AND c.user_id = @user_id
     """
@@ -291,23 +453,61 @@ def delete_user_document(user_id, document_id):
     for doc in documents:
         documents_container.delete_item(doc['id'], partition_key=doc['user_id'])
 
-def delete_user_document_chunks(document_id):
-    # Use Azure AI Search to delete all chunks related to the document
-    search_client_user.delete_documents(
-        actions=[
-            {"@search.action": "delete", "id": chunk['id']} for chunk in 
-            search_client_user.search(
-                search_text="*",
-                filter=f"document_id eq '{document_id}'",
-                select="id"  # Only select the ID for deletion
-            )
-        ]
-    )
+def get_document_chunk_count(user_id, document_id, version=None):
+    # Read the chunk count recorded at ingestion; None for documents ingested before it was
+    query = """
+        SELECT c.chunk_count, c.version
+        FROM c
+        WHERE c.id = @document_id AND c.user_id = @user_id
+    """
+    parameters = [
+        {"name": "@document_id", "value": document_id},
+        {"name": "@user_id", "value": user_id}
+    ]
+    documents = list(documents_container.query_items(query=query, parameters=parameters, enable_cross_partition_query=True))
+
+    for doc in documents:
+        if version is None or str(doc['version']) == str(version):
+            return doc.get('chunk_count')
+    return None
+
+def get_document_chunk_ids(user_id, document_id, chunk_count=None, version=None):
+    if chunk_count is not None:
+        # Chunk ids are {document_id}_{idx}, so every key is known without searching
+        return [f"{document_id}_{idx}" for idx in range(chunk_count)]
+
+    # Documents ingested before chunk counts were recorded are found by search instead
+    return [chunk['id'] for chunk in find_user_chunks(user_id, document_id=document_id, version=version)]
+
+def delete_chunks(user_id, document_id, chunk_count=None, version=None):
+    chunk_ids = get_document_chunk_ids(user_id, document_id, chunk_count, version)
+
+    # Delete by key in parallel batches, retrying failed keys per batch
+    results = write_user_chunks(user_id, [{"id": chunk_id} for chunk_id in chunk_ids], 'delete')
+    failed_chunks = get_failed_search_documents(results)
+    if failed_chunks:
+        raise Exception(f'{len(failed_chunks)} of {len(chunk_ids)} chunks could not be deleted')
+
+    return len(chunk_ids)
+
+def delete_user_document_chunks(document_id, user_id, chunk_count=None):
+    # Remember whether the document was the current version before its chunks go
+    current_chunks = find_user_chunks(user_id, document_id=document_id, current=True, top=1)
+
+    chunks_deleted = delete_chunks(user_id, document_id, chunk_count)
+
+    # The newest remaining version of the file takes over as current
+    if current_chunks:
+        promote_latest_version(user_id, current_chunks[0]['file_name'])
+
+    # Invalidate the user's cached search results
+    bump_search_generation(user_id)
+    return chunks_deleted
 
 def delete_user_document_version(user_id, document_id, version):
     # Query to find the specific version of the document
     query = """
-        SELECT c.id 
+        SELECT c.id, c.user_id
         FROM c 
         WHERE c.id = @document_id AND c.user_id = @user_id AND c.version = @version
     """
@@ -322,47 +522,422 @@ def delete_user_document_version(user_id, document_id, version):
     for doc in documents:
         documents_container.delete_item(doc['id'], partition_key=doc['user_id'])
 
-def delete_user_document_version_chunks(document_id, version):
-    # Use Azure AI Search to delete chunks for the specific document version
-    search_client_user.delete_documents(
-        actions=[
-            {"@search.action": "delete", "id": chunk['id']} for chunk in 
-            search_client_user.search(
+def delete_user_document_version_chunks(document_id, version, user_id, chunk_count=None):
+    # Remember whether the version was current before its chunks go
+    current_chunks = find_user_chunks(user_id, document_id=document_id, version=version, current=True, top=1)
+
+    chunks_deleted = delete_chunks(user_id, document_id, chunk_count, version)
+
+    # The newest remaining version of the file takes over as current
+    if current_chunks:
+        promote_latest_version(user_id, current_chunks[0]['file_name'])
+
+    # Invalidate the user's cached search results
+    bump_search_generation(user_id)
+    return chunks_deleted
+
+def quote_filter_value(value):
+    # OData string literals escape a single quote by doubling it
+    return "'" + str(value).replace("'", "''") + "'"
+
+def find_user_chunks(user_id, file_name=None, document_id=None, exclude_document_id=None, version=None, current=None, top=None):
+    # current=True matches current chunks, including ones indexed before is_current existed;
+    # current=False matches only chunks of superseded versions
+    if NEXUS_SEARCH_BACKEND == 'local':
+        return find_local_index_documents(user_id, lambda chunk: (
+            (file_name is None or chunk['file_name'] == file_name)
+            and (document_id is None or chunk['document_id'] == document_id)
+            and (exclude_document_id is None or chunk['document_id'] != exclude_document_id)
+            and (version is None or str(chunk['version']) == str(version))
+            and (current is None or chunk.get('is_current', True) == current)
+        ))[:top]
+
+    filters = [f"user_id eq {quote_filter_value(user_id)}"]
+    if file_name is not None:
+        filters.append(f"file_name eq {quote_filter_value(file_name)}")
+    if document_id is not None:
+        filters.append(f"document_id eq {quote_filter_value(document_id)}")
+    if exclude_document_id is not None:
+        filters.append(f"document_id ne {quote_filter_value(exclude_document_id)}")
+    if version is not None:
+        filters.append(f"version eq {int(version)}")
+    if current is not None:
+        filters.append("is_current ne false" if current else "is_current eq false")
+
+    return [
+        dict(chunk) for chunk in search_client_user.search(
+            search_text="*",
+            filter=" and ".join(filters),
+            select=["id", "document_id", "file_name", "version"],
+            top=top
+        )
+    ]
+
+def iter_document_chunks(user_id, document_id, version=None, current_only=False):
+    # The local index already holds every row in memory, so just sort the matches
+    if NEXUS_SEARCH_BACKEND == 'local':
+        chunks = find_local_index_documents(user_id, lambda chunk: (
+            chunk['document_id'] == document_id
+            and (version is None or str(chunk['version']) == str(version))
+            and (not current_only or chunk.get('is_current', True))
+        ))
+        yield from sorted(chunks, key=lambda chunk: chunk['chunk_sequence'])
+        return
+
+    filters = [f"document_id eq {quote_filter_value(document_id)}", f"user_id eq {quote_filter_value(user_id)}"]
+    if version is not None:
+        filters.append(f"version eq {int(version)}")
+    if current_only:
+        filters.append("is_current ne false")
+
+    # Walk the chunks in sequence order one page at a time, starting each page
+    # after the last sequence seen so only one page is ever held in memory
+    last_sequence = -1
+    while True:
+        page = [
+            dict(chunk) for chunk in search_client_user.search(
                 search_text="*",
-                filter=f"document_id eq '{document_id}' and version eq {version}",
-                select="id"  # Only select the ID for deletion
+                filter=" and ".join(filters + [f"chunk_sequence gt {last_sequence}"]),
+                order_by=["chunk_sequence asc"],
+                top=CHUNK_EXPORT_PAGE_SIZE,
+                select=CHUNK_EXPORT_FIELDS
             )
         ]
-    )
+        yield from page
+
+        if len(page) < CHUNK_EXPORT_PAGE_SIZE:
+            return
+        last_sequence = page[-1]['chunk_sequence']
+
+def reassemble_document_text(chunks):
+    # Yield the document's text piece by piece, dropping the words each chunk
+    # shares with the one before it according to their character offsets
+    previous_end = None
+    for i, chunk in enumerate(chunks):
+        text = chunk['chunk_text']
+        chunk_start = chunk.get('chunk_start')
+
+        if i > 0:
+            if previous_end is None or chunk_start is None:
+                text = '\n' + text
+            elif chunk_start <= previous_end:
+                text = text[previous_end - chunk_start:]
+            else:
+                # Chunks indexed before chunk_separator existed were split on spaces
+                text = (chunk.get('chunk_separator') or ' ') + text
+
+        previous_end = chunk.get('chunk_end')
+        yield text
+
+def set_current_version(user_id, file_name, document_id, chunk_count=None):
+    # Mark one upload as the current version of the file and retire the ones that were current.
+    # Chunk keys follow from the chunk counts recorded at ingestion rather than a search, which
+    # may not see chunks written moments ago yet. A merge keeps the chunk's vector only
+    # because the embedding field is stored.
+    query = """
+        SELECT *
+        FROM c
+        WHERE c.user_id = @user_id AND c.file_name = @file_name AND c.type = 'document_metadata'
+        AND c.id != @document_id AND (NOT IS_DEFINED(c.is_current) OR c.is_current = true)
+    """
+    parameters = [
+        {"name": "@user_id", "value": user_id},
+        {"name": "@file_name", "value": file_name},
+        {"name": "@document_id", "value": document_id}
+    ]
+    retired_documents = list(documents_container.query_items(query=query, parameters=parameters, enable_cross_partition_query=True))
+
+    updates = [
+        {"id": chunk_id, "is_current": True}
+        for chunk_id in get_document_chunk_ids(user_id, document_id, chunk_count)
+    ]
+    for document in retired_documents:
+        updates.extend(
+            {"id": chunk_id, "is_current": False}
+            for chunk_id in get_document_chunk_ids(user_id, document['id'], document.get('chunk_count'))
+        )
+
+    if updates:
+        write_user_chunks(user_id, updates, 'merge')
 
-def hybrid_search(query, user_id, top_n):
+    # Record the switch on the metadata, so the next one only has to retire this upload
+    for document in retired_documents:
+        document['is_current'] = False
+        documents_container.upsert_item(document)
+
+    try:
+        document = documents_container.read_item(item=document_id, partition_key=user_id)
+        document['is_current'] = True
+        documents_container.upsert_item(document)
+    except exceptions.CosmosResourceNotFoundError:
+        pass
+
+def mark_document_failed(user_id, document_id):
+    # Hide an upload whose ingestion stopped part way; its metadata may not exist yet
     try:
-        # Step 1: Generate the query embedding
-        query_embedding = generate_embedding(query)
+        document = documents_container.read_item(item=document_id, partition_key=user_id)
+        document['status'] = 'failed'
+        documents_container.upsert_item(document)
+    except exceptions.CosmosResourceNotFoundError:
+        pass
+
+def promote_latest_version(user_id, file_name):
+    # Find the newest version of the file that still has metadata
+    query = """
+        SELECT TOP 1 c.id, c.chunk_count
+        FROM c
+        WHERE c.user_id = @user_id AND c.file_name = @file_name AND c.type = 'document_metadata'
+        AND (NOT IS_DEFINED(c.status) OR c.status = 'indexed')
+        ORDER BY c.version DESC
+    """
+    parameters = [
+        {"name": "@user_id", "value": user_id},
+        {"name": "@file_name", "value": file_name}
+    ]
+    documents = list(documents_container.query_items(query=query, parameters=parameters, enable_cross_partition_query=True))
+
+    if documents:
+        set_current_version(user_id, file_name, documents[0]['id'], documents[0].get('chunk_count'))
+
+def get_search_generation_id(user_id):
+    return f"search_generation_{user_id}"
+
+def get_search_generation(user_id):
+    try:
+        # The generation lives beside the user's document metadata, in the same partition
+        item = documents_container.read_item(item=get_search_generation_id(user_id), partition_key=user_id)
+        return item['generation'], item.get('bumped_at', 0)
+    except exceptions.CosmosResourceNotFoundError:
+        return 0, 0
+
+def bump_search_generation(user_id):
+    item_id = get_search_generation_id(user_id)
+
+    # Read, increment and replace with an ETag check so concurrent bumps are never lost
+    while True:
+        try:
+            item = documents_container.read_item(item=item_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            try:
+                documents_container.create_item({"id": item_id, "user_id": user_id, "type": "search_generation", "generation": 1, "bumped_at": time.time()})
+                return 1
+            except exceptions.CosmosResourceExistsError:
+                continue
+
+        item['generation'] += 1
+        item['bumped_at'] = time.time()
+        try:
+            documents_container.replace_item(
+                item=item_id,
+                body=item,
+                etag=item['_etag'],
+                match_condition=MatchConditions.IfNotModified
+            )
+            return item['generation']
+        except exceptions.CosmosAccessConditionFailedError:
+            continue
+
+def hybrid_search(query, user_id, top_n, skip=0, select=SEARCH_RESULT_FIELDS, query_embedding=None):
+    # Read the generation before searching, so results computed while a document
+    # changes are stored under a generation that is already out of date
+    try:
+        generation, bumped_at = get_search_generation(user_id)
+    except Exception as e:
+        return run_hybrid_search(query, user_id, top_n, skip, select, query_embedding)
+
+    cache_key = (user_id, generation, query, top_n, skip, tuple(select))
+    results = search_result_cache.get(cache_key)
+    if results is None:
+        results = run_hybrid_search(query, user_id, top_n, skip, select, query_embedding)
+        # The index refreshes a moment after a bump, so results from just after it may
+        # still include deleted or retired chunks and are not cached
+        if results is not None and time.time() - bumped_at >= SEARCH_RESULT_CACHE_SETTLE_SECONDS:
+            search_result_cache.set(cache_key, results)
+    return results
+
+def run_hybrid_search(query, user_id, top_n, skip=0, select=SEARCH_RESULT_FIELDS, query_embedding=None):
+    try:
+        # Step 1: Generate the query embedding, unless the caller already has it
+        if query_embedding is None:
+            query_embedding = generate_query_embedding(query)
 
         if query_embedding is None:
             return None
 
-        # Step 2: Create a vectorized query
-        vector_query = VectorizedQuery(vector=query_embedding, k_nearest_neighbors=top_n, fields="embedding")
+        # Step 2: The local index answers with a vector-only search over the current versions of the user's own chunks
+        if NEXUS_SEARCH_BACKEND == 'local':
+            results = search_local_index(user_id, query_embedding, skip + top_n, lambda chunk: chunk.get('is_current', True))[skip:]
+            return [{key: result[key] for key in select + ["@search.score"] if key in result} for result in results]
+
+        # Step 3: Create a vectorized query; the nearest neighbours must reach past the skipped results
+        vector_query = VectorizedQuery(vector=query_embedding, k_nearest_neighbors=skip + top_n, fields="embedding")
 
-        # Step 3: Perform the hybrid search
+        # Step 4: Perform the hybrid search, asking the service for exactly one page
         results = search_client_user.search(
             search_text=query,
             vector_queries=[vector_query],
-            filter=f"user_id eq '{user_id}'",
-            select=["id", "chunk_text", "chunk_id", "file_name", "user_id", "version", "chunk_sequence", "upload_date"]
+            filter=f"user_id eq '{user_id}' and is_current ne false",  # Only the current version of each document
+            select=select,
+            top=top_n,
+            skip=skip
         )
-        
-        # Step 4: Collect top_n results
-        limited_results = []
-        for i, result in enumerate(results):
-            if i >= top_n:
-                break
-            limited_results.append(result)
 
-        return limited_results
+        # Step 5: Collect the page
+        return [dict(result) for result in results]
 
     except Exception as e:
         return None
 
+def batch_hybrid_search(queries, user_id, top_n, select=SEARCH_RESULT_FIELDS, deduplicate=False):
+    # Step 1: Embed every query up front in multi-input calls
+    query_embeddings = generate_query_embeddings(queries)
+
+    # Step 2: Run the hybrid searches concurrently; map keeps the query order
+    with ThreadPoolExecutor(max_workers=AZURE_AI_SEARCH_MAX_WORKERS) as executor:
+        batch_results = list(executor.map(
+            lambda args: hybrid_search(args[0], user_id, top_n, 0, select, args[1]),
+            zip(queries, query_embeddings)
+        ))
+
+    if any(results is None for results in batch_results):
+        return None
+
+    # Step 3: Optionally keep each chunk only under the query it scored highest for
+    if deduplicate:
+        best = {}
+        for query_index, results in enumerate(batch_results):
+            for result in results:
+                if result['id'] not in best or result['@search.score'] > best[result['id']][1]:
+                    best[result['id']] = (query_index, result['@search.score'])
+        batch_results = [
+            [result for result in results if best[result['id']][0] == query_index]
+            for query_index, results in enumerate(batch_results)
+        ]
+
+    return batch_results
+
+def reranked_hybrid_search(query, user_id, top_n, mmr=True, mmr_lambda=0.5, merge_adjacent=True):
+    # Step 1: Fetch a wider pool of candidates than will be returned
+    candidate_count = top_n * SEARCH_RERANK_CANDIDATE_MULTIPLIER if mmr else top_n
+    results = hybrid_search(query, user_id, candidate_count, 0, SEARCH_RERANK_FIELDS)
+    if results is None:
+        return None
+
+    # Step 2: Pick a relevant but diverse subset. Embeddings are not retrievable from
+    # the index, so they are looked up in the cache ingestion filled; when any are
+    # missing, chunks are compared by their words rather than embedded again here
+    if mmr and results:
+        embeddings = get_cached_embeddings([result['chunk_text'] for result in results])
+        query_embedding = generate_query_embedding(query)
+        if query_embedding is not None and all(embedding is not None for embedding in embeddings):
+            results = mmr_rerank(query_embedding, results, embeddings, top_n, mmr_lambda)
+        else:
+            results = mmr_rerank_by_text(results, top_n, mmr_lambda)
+
+    # Step 3: Join neighbouring chunks of the same document into single passages
+    if merge_adjacent:
+        results = merge_adjacent_chunks(results)
+
+    return results
+
+def group_hybrid_search(query, group_ids, top_n, query_embedding=None):
+    try:
+        if query_embedding is None:
+            query_embedding = generate_query_embedding(query)
+
+        if query_embedding is None:
+            return None
+
+        vector_query = VectorizedQuery(vector=query_embedding, k_nearest_neighbors=top_n, fields="embedding")
+
+        # Only search the chunks shared with the requested groups
+        results = search_client_group.search(
+            search_text=query,
+            vector_queries=[vector_query],
+            filter=f"search.in(group_id, {quote_filter_value(','.join(group_ids))}, ',')",
+            select=SEARCH_GROUP_RESULT_FIELDS,
+            top=top_n
+        )
+        return [dict(result) for result in results]
+
+    except Exception as e:
+        return None
+
+def federated_search(query, user_id, group_ids, top_n, select=SEARCH_RESULT_FIELDS):
+    # Step 1: Embed the query once for every source
+    query_embedding = generate_query_embedding(query)
+    if query_embedding is None:
+        return None, []
+
+    # Step 2: Search the user and group indexes concurrently
+    futures = {
+        "user": search_executor.submit(hybrid_search, query, user_id, top_n, 0, select, query_embedding)
+    }
+    if group_ids:
+        futures["group"] = search_executor.submit(group_hybrid_search, query, group_ids, top_n, query_embedding)
+
+    # Step 3: Wait no longer than the latency budget; late or failed sources are left out
+    done, not_done = wait(futures.values(), timeout=SEARCH_SOURCE_TIMEOUT_SECONDS)
+    ranked_lists = {}
+    unavailable_sources = []
+    for source, future in futures.items():
+        results = future.result() if future in done else None
+        if results is None:
+            unavailable_sources.append(source)
+        else:
+            ranked_lists[source] = results
+
+    if not ranked_lists:
+        return None, unavailable_sources
+
+    # Step 4: Merge the ranked lists with Reciprocal Rank Fusion
+    return reciprocal_rank_fusion(ranked_lists, top_n), unavailable_sources
+
+def format_search_result(result, ids_only=False):
+    if ids_only:
+        search_result = {"id": result["id"], "similarity_score": result["@search.score"]}
+        if "chunk_ids" in result:
+            search_result["chunk_ids"] = result["chunk_ids"]
+        if "source" in result:
+            search_result["source"] = result["source"]
+        return search_result
+
+    search_result = {
+        "chunk_id": result["chunk_id"],
+        "chunk_text": result["chunk_text"],
+        "similarity_score": result["@search.score"],  # Similarity score returned by Azure Cognitive Search
+        "metadata": {
+            "file_name": result["file_name"],
+            "user_id": result.get("user_id"),
+            "chunk_sequence": result["chunk_sequence"],
+            "upload_date": result["upload_date"],
+            "version": result["version"]
+        }
+    }
+
+    # Merged passages list every chunk they were built from
+    if "chunk_ids" in result:
+        search_result["chunk_ids"] = result["chunk_ids"]
+
+    # Federated results say which index they came from
+    if "source" in result:
+        search_result["source"] = result["source"]
+    if "group_id" in result:
+        search_result["metadata"]["group_id"] = result["group_id"]
+    return search_result
+
+def encode_continuation_token(query, skip):
+    # The token records where the next page starts and which query it belongs to
+    token = {"skip": skip, "query": hashlib.sha256(query.encode('utf-8')).hexdigest()[:16]}
+    return base64.urlsafe_b64encode(json.dumps(token).encode('utf-8')).decode('ascii')
+
+def decode_continuation_token(token, query):
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+        skip = int(decoded['skip'])
+    except Exception as e:
+        raise ValueError('Invalid continuation_token')
+
+    if skip < 0 or decoded.get('query') != hashlib.sha256(query.encode('utf-8')).hexdigest()[:16]:
+        raise ValueError('Invalid continuation_token')
+    return skip
@@ -0,0 +1,128 @@
+from config import jobs_container, exceptions, MatchConditions, ThreadPoolExecutor, JOB_MAX_WORKERS, JOB_INSTANCE_ID, JOB_STALE_SECONDS, JOB_SWEEP_SECONDS, os, uuid, datetime, timezone, time, threading
+
+#***************** Workers *****************
+# Background worker pool shared by all long-running jobs
+job_executor = ThreadPoolExecutor(max_workers=JOB_MAX_WORKERS)
+# Ids of the jobs submitted to this process's pool that have not finished yet
+active_job_ids = set()
+
+#***************** Functions *****************
+# The functions support background job management
+
+def get_job_timestamp():
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def create_job(user_id, job_type, job_id=None, **fields):
+    formatted_time = get_job_timestamp()
+
+    # Record which instance and process own the job so a restart can find it
+    job = {
+        "id": job_id or str(uuid.uuid4()),
+        "user_id": user_id,
+        "type": job_type,
+        "status": "queued",
+        "instance_id": JOB_INSTANCE_ID,
+        "worker_pid": os.getpid(),
+        "created_at": formatted_time,
+        "updated_at": formatted_time,
+        **fields
+    }
+    return jobs_container.create_item(job)
+
+def update_job(job, **fields):
+    job.update(fields)
+    job['updated_at'] = get_job_timestamp()
+    job.update(jobs_container.upsert_item(job))
+    return job
+
+def get_job(job_id, user_id):
+    try:
+        # Jobs are partitioned by user_id, so other users' jobs are never found
+        return jobs_container.read_item(item=job_id, partition_key=user_id)
+    except exceptions.CosmosResourceNotFoundError:
+        return None
+
+def format_job(job):
+    # Only return the fields that are meaningful to the caller
+    return {
+        key: job[key] for key in
+        ["id", "type", "status", "file_name", "document_id", "chunks_processed", "failed_chunks", "error", "created_at", "updated_at"]
+        if key in job
+    }
+
+def submit_job(job, runner, *args):
+    active_job_ids.add(job['id'])
+    future = job_executor.submit(runner, job, *args)
+    future.add_done_callback(lambda future: active_job_ids.discard(job['id']))
+
+def is_worker_alive(pid):
+    # A job owned by this very process that is not running in it can only be a reused pid
+    if not pid or pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+def resume_jobs(job_type, runner, can_resume):
+    # Find unfinished jobs of this type that were started on this instance, or that have not
+    # been updated for JOB_STALE_SECONDS on any instance, e.g. one that was scaled in
+    stale_before = datetime.fromtimestamp(time.time() - JOB_STALE_SECONDS, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    query = """
+        SELECT *
+        FROM c
+        WHERE c.type = @type AND NOT ARRAY_CONTAINS(['done', 'failed'], c.status)
+        AND (c.instance_id = @instance_id OR c.updated_at < @stale_before)
+    """
+    parameters = [
+        {"name": "@type", "value": job_type},
+        {"name": "@instance_id", "value": JOB_INSTANCE_ID},
+        {"name": "@stale_before", "value": stale_before}
+    ]
+    jobs = list(jobs_container.query_items(query=query, parameters=parameters, enable_cross_partition_query=True))
+
+    for job in jobs:
+        # Leave jobs alone while this process or another worker process on this instance runs them
+        if job['id'] in active_job_ids:
+            continue
+        if job.get('instance_id') == JOB_INSTANCE_ID and is_worker_alive(job.get('worker_pid')):
+            continue
+
+        # Claim the job with an ETag check so only one worker process resumes it
+        job['instance_id'] = JOB_INSTANCE_ID
+        job['worker_pid'] = os.getpid()
+        job['updated_at'] = get_job_timestamp()
+        try:
+            job = jobs_container.replace_item(
+                item=job['id'],
+                body=job,
+                etag=job['_etag'],
+                match_condition=MatchConditions.IfNotModified
+            )
+        except exceptions.CosmosAccessConditionFailedError:
+            continue
+
+        if can_resume(job):
+            update_job(job, status='queued')
+            submit_job(job, runner)
+        else:
+            update_job(job, status='failed', error='Job was interrupted and could not be resumed, please upload the file again')
+
+def schedule_job_sweep(sweeps):
+    # Periodically re-run the resume sweeps so jobs left behind by an instance that
+    # went away are picked up without waiting for this instance to restart
+    def run_sweeps():
+        for sweep in sweeps:
+            try:
+                sweep()
+            except Exception as e:
+                #print(f"Error sweeping jobs: {str(e)}")
+                pass
+        schedule_job_sweep(sweeps)
+
+    timer = threading.Timer(JOB_SWEEP_SECONDS, run_sweeps)
+    timer.daemon = True
+    timer.start()
@@ -0,0 +1,114 @@
+from config import np, SEARCH_RRF_K
+
+#***************** Functions *****************
+# The functions support re-ranking retrieved chunks
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+def mmr_rerank(query_embedding, results, embeddings, top_n, mmr_lambda=0.5):
+    # Maximal Marginal Relevance over the candidates' embeddings
+    if not results:
+        return []
+
+    candidates = normalize_rows(np.asarray(embeddings, dtype=np.float32))
+    query = np.asarray(query_embedding, dtype=np.float32)
+    query = query / (np.linalg.norm(query) or 1)
+
+    selected = select_mmr(candidates @ query, candidates @ candidates.T, top_n, mmr_lambda)
+    return [results[i] for i in selected]
+
+def mmr_rerank_by_text(results, top_n, mmr_lambda=0.5):
+    # Maximal Marginal Relevance without embeddings: relevance is the search score
+    # scaled to the best one, similarity is the word overlap between chunks
+    if not results:
+        return []
+
+    scores = np.array([result['@search.score'] for result in results], dtype=np.float32)
+    relevance = scores / (scores.max() or 1)
+
+    words = [set(result['chunk_text'].lower().split()) for result in results]
+    similarity = np.zeros((len(results), len(results)), dtype=np.float32)
+    for i in range(len(results)):
+        for j in range(i, len(results)):
+            union = len(words[i] | words[j])
+            similarity[i, j] = similarity[j, i] = len(words[i] & words[j]) / union if union else 0
+
+    selected = select_mmr(relevance, similarity, top_n, mmr_lambda)
+    return [results[i] for i in selected]
+
+def select_mmr(relevance, similarity, top_n, mmr_lambda):
+    # Repeatedly pick the candidate that is most relevant to the query while
+    # least similar to the candidates already picked
+    selected = []
+    available = np.ones(len(relevance), dtype=bool)
+    max_similarity = np.zeros(len(relevance), dtype=np.float32)  # to the closest selected candidate
+
+    for _ in range(min(top_n, len(relevance))):
+        scores = mmr_lambda * relevance - (1 - mmr_lambda) * max_similarity
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+
+        selected.append(best)
+        available[best] = False
+        max_similarity = np.maximum(max_similarity, similarity[:, best])
+
+    return selected
+
+def merge_adjacent_chunks(results):
+    # Join hits from consecutive chunks of the same document version into one passage,
+    # placed where its best-ranked chunk was and scored with the best chunk's score
+    groups = {}
+    for rank, result in enumerate(results):
+        key = (result.get('document_id'), result.get('version'))
+        groups.setdefault(key, []).append((rank, result))
+
+    passages = []
+    for group in groups.values():
+        group.sort(key=lambda item: item[1]['chunk_sequence'])
+
+        runs = [[group[0]]]
+        for item in group[1:]:
+            if item[1]['chunk_sequence'] == runs[-1][-1][1]['chunk_sequence'] + 1:
+                runs[-1].append(item)
+            else:
+                runs.append([item])
+
+        for run in runs:
+            rank = min(item[0] for item in run)
+            passages.append((rank, merge_chunk_run([item[1] for item in run])))
+
+    passages.sort(key=lambda item: item[0])
+    return [passage for rank, passage in passages]
+
+def merge_chunk_run(run):
+    if len(run) == 1:
+        return run[0]
+
+    passage = dict(run[0])
+    passage['chunk_ids'] = [chunk['chunk_id'] for chunk in run]
+    passage['@search.score'] = max(chunk['@search.score'] for chunk in run)
+
+    for chunk in run[1:]:
+        # Chunks overlap by a few words; the character offsets tell us how much to drop
+        if passage.get('chunk_end') is not None and chunk.get('chunk_start') is not None and chunk['chunk_start'] <= passage['chunk_end']:
+            passage['chunk_text'] += chunk['chunk_text'][passage['chunk_end'] - chunk['chunk_start']:]
+        else:
+            passage['chunk_text'] += '\n' + chunk['chunk_text']
+        passage['chunk_end'] = chunk.get('chunk_end')
+
+    return passage
+
+def reciprocal_rank_fusion(ranked_lists, top_n, k=SEARCH_RRF_K):
+    # Score every result by the sum of 1 / (k + rank) over the lists it appears in,
+    # which merges lists whose raw scores are not comparable with each other
+    fused = {}
+    for source, results in ranked_lists.items():
+        for rank, result in enumerate(results, start=1):
+            if result['id'] not in fused:
+                fused[result['id']] = dict(result, source=source, **{"@search.score": 0.0})
+            fused[result['id']]['@search.score'] += 1 / (k + rank)
+
+    return sorted(fused.values(), key=lambda result: result['@search.score'], reverse=True)[:top_n]
@@ -0,0 +1,119 @@
+from config import json, time, ThreadPoolExecutor, HttpResponseError, search_client_user, NEXUS_SEARCH_BACKEND, AZURE_AI_SEARCH_BATCH_MAX_DOCUMENTS, AZURE_AI_SEARCH_BATCH_MAX_BYTES, AZURE_AI_SEARCH_MAX_WORKERS, AZURE_AI_SEARCH_MAX_RETRIES, AZURE_AI_SEARCH_VECTOR_TYPE, np
+from process_vector_index import write_local_index_documents
+
+#***************** Functions *****************
+# The functions support writing documents to Azure AI Search indexes
+
+# Per-document status codes that are worth retrying
+RETRIABLE_STATUS_CODES = [409, 422, 429, 503]
+
+def write_search_documents(search_client, documents, action='upload'):
+    # Split the documents into batches that respect both size limits
+    batches = split_search_batches(documents)
+
+    # Send the batches in parallel
+    with ThreadPoolExecutor(max_workers=AZURE_AI_SEARCH_MAX_WORKERS) as executor:
+        batch_results = list(executor.map(
+            lambda batch: write_search_batch(search_client, batch, action),
+            batches
+        ))
+
+    # Merge the per-document results of every batch, keyed by document id
+    results = {}
+    for batch_result in batch_results:
+        results.update(batch_result)
+    return results
+
+def write_user_chunks(user_id, documents, action='upload'):
+    # Write the user's chunks to whichever search backend is configured
+    if NEXUS_SEARCH_BACKEND == 'local':
+        return write_local_index_documents(user_id, documents, action)
+
+    if action == 'upload':
+        documents = [dict(document, embedding=prepare_index_vector(document['embedding'])) for document in documents]
+    return write_search_documents(search_client_user, documents, action)
+
+def split_search_batches(documents):
+    batches = []
+    batch = []
+    batch_bytes = 0
+
+    for document in documents:
+        document_bytes = len(json.dumps(document).encode('utf-8'))
+
+        # Start a new batch when this document would exceed either limit
+        if batch and (len(batch) >= AZURE_AI_SEARCH_BATCH_MAX_DOCUMENTS
+                      or batch_bytes + document_bytes > AZURE_AI_SEARCH_BATCH_MAX_BYTES):
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+
+        batch.append(document)
+        batch_bytes += document_bytes
+
+    if batch:
+        batches.append(batch)
+    return batches
+
+def write_search_batch(search_client, batch, action):
+    send = {
+        'upload': search_client.upload_documents,
+        'merge': search_client.merge_documents,
+        'delete': search_client.delete_documents
+    }[action]
+
+    results = {}
+    pending = batch
+
+    for attempt in range(AZURE_AI_SEARCH_MAX_RETRIES + 1):
+        try:
+            indexing_results = send(documents=pending)
+        except HttpResponseError as e:
+            # Halve batches the service rejects as too large and send each half
+            if e.status_code == 413 and len(pending) > 1:
+                middle = len(pending) // 2
+                results.update(write_search_batch(search_client, pending[:middle], action))
+                results.update(write_search_batch(search_client, pending[middle:], action))
+                return results
+
+            if attempt == AZURE_AI_SEARCH_MAX_RETRIES:
+                for document in pending:
+                    results[document['id']] = {"succeeded": False, "status_code": e.status_code, "error": str(e)}
+                return results
+
+            time.sleep(2 ** attempt)
+            continue
+
+        # Record every document's result and retry only the failed, retriable keys
+        documents_by_key = {document['id']: document for document in pending}
+        retry = []
+        for result in indexing_results:
+            results[result.key] = {
+                "succeeded": result.succeeded,
+                "status_code": result.status_code,
+                "error": result.error_message
+            }
+            if not result.succeeded and result.status_code in RETRIABLE_STATUS_CODES:
+                retry.append(documents_by_key[result.key])
+
+        if not retry or attempt == AZURE_AI_SEARCH_MAX_RETRIES:
+            return results
+
+        pending = retry
+        time.sleep(2 ** attempt)
+
+    return results
+
+def get_failed_search_documents(results):
+    return [
+        {"id": key, "status_code": result["status_code"], "error": result["error"]}
+        for key, result in results.items() if not result["succeeded"]
+    ]
+
+def prepare_index_vector(embedding):
+    # Match the element type of the index's vector field. For Edm.Half the whole vector
+    # is rounded to float16 at once; widening it back is exact, so the service stores
+    # the same values without any per-element formatting here.
+    if AZURE_AI_SEARCH_VECTOR_TYPE == 'Edm.Half':
+        return np.asarray(embedding, dtype=np.float16).astype(np.float32).tolist()
+    return np.asarray(embedding, dtype=np.float32).tolist()
@@ -0,0 +1,307 @@
+from config import os, json, np, threading, fcntl, hashlib, contextmanager, LOCAL_VECTOR_INDEX_DIR
+
+#***************** Classes *****************
+# The classes support the local in-process vector index
+
+class LocalVectorIndex:
+    # One user's chunks: unit-length float32 embeddings in a memory-mapped matrix,
+    # plus a JSON snapshot of each row's id and fields and an append-only log of the
+    # row changes made since that snapshot. Each write only appends its own changes;
+    # the snapshot is rewritten once the log outgrows it, or when compaction
+    # reclaims deleted rows. Writes from other worker processes are picked up by
+    # replaying the log, or by reloading whenever the snapshot is replaced.
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.vectors_path = os.path.join(directory, 'vectors.f32')
+        self.rows_path = os.path.join(directory, 'rows.json')
+        self.lock_path = os.path.join(directory, 'index.lock')
+        self.lock = threading.RLock()
+        self.loaded_version = None
+        self.reset()
+        os.makedirs(directory, exist_ok=True)
+
+    def reset(self):
+        self.rows = []  # the fields of every row, None for deleted rows
+        self.row_ids = {}  # id -> row number
+        self.alive = np.zeros(0, dtype=bool)
+        self.dimensions = None
+        self.capacity = 0
+        self.vectors = None
+        self.generation = 0  # names the log that belongs to the current snapshot
+        self.snapshot_size = 0
+        self.log_offset = 0  # bytes of the log already applied
+        self.pending = []  # log entries not yet written
+        self.needs_snapshot = False
+
+    def get_version(self):
+        try:
+            stat = os.stat(self.rows_path)
+            return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            return None
+
+    def get_log_path(self):
+        return os.path.join(self.directory, f'rows.{self.generation}.log')
+
+    def load(self):
+        # Re-read the snapshot only when another writer has replaced it
+        version = self.get_version()
+        if version != self.loaded_version:
+            self.reset()
+            if version is not None:
+                with open(self.rows_path, 'r', encoding='utf-8') as f:
+                    state = json.load(f)
+                self.rows = state['rows']
+                self.generation = state.get('generation', 0)
+                self.snapshot_size = version[2]
+                self.row_ids = {row['id']: i for i, row in enumerate(self.rows) if row is not None}
+                self.resize(state['capacity'], state['dimensions'])
+                self.alive[:len(self.rows)] = [row is not None for row in self.rows]
+            self.loaded_version = version
+
+        # Then apply whatever other writers have appended to the log since
+        try:
+            with open(self.get_log_path(), 'rb') as f:
+                f.seek(self.log_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+
+        # A writer may still be appending; only whole lines are applied
+        data = data[:data.rfind(b'\n') + 1]
+        for line in data.splitlines():
+            self.apply(json.loads(line))
+        self.log_offset += len(data)
+
+    def resize(self, capacity, dimensions):
+        # Map the vectors file at its current size, keeping the alive flags of existing rows
+        self.dimensions = dimensions
+        if capacity == self.capacity:
+            return
+        self.capacity = capacity
+        self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r+', shape=(capacity, dimensions)) if capacity else None
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:min(capacity, len(self.alive))] = self.alive[:capacity]
+        self.alive = alive
+
+    def apply(self, entry):
+        # Apply one log entry to the in-memory rows
+        if 'capacity' in entry:
+            self.resize(entry['capacity'], entry['dimensions'])
+            return
+
+        row = entry['row']
+        if 'fields' in entry:
+            if row == len(self.rows):
+                self.rows.append(entry['fields'])
+            else:
+                self.rows[row] = entry['fields']
+            self.row_ids[entry['fields']['id']] = row
+            self.alive[row] = True
+        elif 'update' in entry:
+            self.rows[row].update(entry['update'])
+        elif self.rows[row] is not None:
+            del self.row_ids[self.rows[row]['id']]
+            self.rows[row] = None
+            self.alive[row] = False
+
+    def record(self, entry):
+        # Apply a change now and write it to the log on the next save
+        self.apply(entry)
+        self.pending.append(entry)
+
+    def save(self):
+        if self.vectors is not None:
+            self.vectors.flush()
+
+        # Rewrite the snapshot once the log has grown past it, which keeps the total write cost linear
+        if self.needs_snapshot or self.log_offset > max(self.snapshot_size, 1024 * 1024):
+            self.save_snapshot()
+        elif self.pending:
+            # Every batch starts with the matrix shape, so readers can remap it before the new rows
+            entries = [{"capacity": self.capacity, "dimensions": self.dimensions}] + self.pending
+            data = ''.join(json.dumps(entry) + '\n' for entry in entries).encode('utf-8')
+            with open(self.get_log_path(), 'ab') as f:
+                f.write(data)
+            self.log_offset += len(data)
+        self.pending = []
+
+    def save_snapshot(self):
+        # Replace the snapshot atomically so readers never see a partial write. It names
+        # a new, empty log, so readers of the new snapshot never replay the old log.
+        old_log_path = self.get_log_path()
+        self.generation += 1
+        state = {"dimensions": self.dimensions, "capacity": self.capacity, "generation": self.generation, "rows": self.rows}
+        temp_path = f"{self.rows_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(temp_path, self.rows_path)
+        if os.path.exists(old_log_path):
+            os.remove(old_log_path)
+
+        self.loaded_version = self.get_version()
+        self.snapshot_size = self.loaded_version[2]
+        self.log_offset = 0
+        self.needs_snapshot = False
+
+    @contextmanager
+    def exclusive(self):
+        # Serialize writers across threads and worker processes
+        with self.lock, open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self.load()
+                yield
+            except Exception:
+                # Changes that never reached the log are dropped by reloading from disk
+                self.loaded_version = False
+                raise
+            finally:
+                self.pending = []
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def ensure_capacity(self, size, dimensions):
+        if self.dimensions is None:
+            self.dimensions = dimensions
+        elif self.dimensions != dimensions:
+            raise Exception(f"Embedding has {dimensions} dimensions, the index expects {self.dimensions}")
+
+        if size <= self.capacity:
+            return
+
+        # Grow the file in place; existing rows keep their position in the matrix
+        capacity = max(size, self.capacity * 2, 1024)
+        with open(self.vectors_path, 'ab') as f:
+            f.truncate(capacity * self.dimensions * 4)
+        self.resize(capacity, self.dimensions)
+
+    def upsert(self, documents):
+        with self.exclusive():
+            for document in documents:
+                fields = {key: value for key, value in document.items() if key != 'embedding'}
+                vector = normalize_vector(document['embedding'])
+
+                row = self.row_ids.get(fields['id'])
+                if row is None:
+                    row = len(self.rows)
+                    self.ensure_capacity(row + 1, len(vector))
+
+                self.vectors[row] = vector
+                self.record({"row": row, "fields": fields})
+            self.save()
+
+    def merge(self, documents):
+        # Update the fields of existing rows, leaving their vectors untouched
+        with self.exclusive():
+            for document in documents:
+                row = self.row_ids.get(document['id'])
+                if row is not None:
+                    self.record({"row": row, "update": {key: value for key, value in document.items() if key != 'embedding'}})
+            self.save()
+
+    def delete(self, ids):
+        with self.exclusive():
+            for row in [self.row_ids[id] for id in ids if id in self.row_ids]:
+                self.record({"row": row, "delete": True})
+
+            # Compact once most of the matrix is tombstones
+            if len(self.rows) - len(self.row_ids) > max(1024, len(self.rows) // 2):
+                self.compact()
+            self.save()
+
+    def find(self, predicate):
+        with self.lock:
+            self.load()
+            return [dict(row) for row in self.rows if row is not None and predicate(row)]
+
+    def compact(self):
+        kept = [i for i, row in enumerate(self.rows) if row is not None]
+        vectors = np.array(self.vectors[kept]) if kept else None
+
+        self.rows = [self.rows[i] for i in kept]
+        self.row_ids = {row['id']: i for i, row in enumerate(self.rows)}
+        self.capacity = 0
+        self.vectors = None
+        self.alive = np.zeros(0, dtype=bool)
+        os.remove(self.vectors_path)
+
+        if kept:
+            self.ensure_capacity(len(kept), self.dimensions)
+            self.vectors[:len(kept)] = vectors
+            self.alive[:len(kept)] = True
+
+        # Row numbers have changed, so the log cannot describe this; write a new snapshot
+        self.needs_snapshot = True
+
+    def search(self, vector, top, predicate=None):
+        with self.lock:
+            self.load()
+            count = len(self.rows)
+            if count == 0:
+                return []
+
+            # Cosine similarity is a single dot product against unit-length rows
+            scores = self.vectors[:count] @ normalize_vector(vector)
+            scores[~self.alive[:count]] = -np.inf
+
+            # Without a filter only the best rows need ordering, otherwise rank
+            # every row and take the best ones that pass the filter
+            if predicate is None and top < count:
+                candidates = np.argpartition(-scores, top)[:top]
+                order = candidates[np.argsort(-scores[candidates])]
+            else:
+                order = np.argsort(-scores)
+
+            results = []
+            for row in order:
+                if scores[row] == -np.inf:
+                    break
+                if predicate is None or predicate(self.rows[row]):
+                    results.append(dict(self.rows[row], **{"@search.score": float(scores[row])}))
+                    if len(results) >= top:
+                        break
+            return results
+
+#***************** Indexes *****************
+# One index per user, opened on first use
+local_indexes = {}
+local_indexes_lock = threading.Lock()
+
+#***************** Functions *****************
+# The functions support the local in-process vector index
+
+def normalize_vector(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+def get_local_index(user_id):
+    with local_indexes_lock:
+        if user_id not in local_indexes:
+            # Hash the user id so any value is a safe directory name
+            directory = os.path.join(LOCAL_VECTOR_INDEX_DIR, hashlib.sha256(user_id.encode('utf-8')).hexdigest())
+            local_indexes[user_id] = LocalVectorIndex(directory)
+        return local_indexes[user_id]
+
+def write_local_index_documents(user_id, documents, action='upload'):
+    index = get_local_index(user_id)
+
+    try:
+        if action == 'upload':
+            index.upsert(documents)
+        elif action == 'merge':
+            index.merge(documents)
+        else:
+            index.delete([document['id'] for document in documents])
+    except Exception as e:
+        return {document['id']: {"succeeded": False, "status_code": 500, "error": str(e)} for document in documents}
+
+    # Report results in the same shape as write_search_documents
+    return {document['id']: {"succeeded": True, "status_code": 200, "error": None} for document in documents}
+
+def find_local_index_documents(user_id, predicate):
+    return get_local_index(user_id).find(predicate)
+
+def search_local_index(user_id, vector, top, predicate=None):
+    return get_local_index(user_id).search(vector, top, predicate)
@@ -1,7 +1,8 @@
-from config import openai, AZURE_OPENAI_LLM_MODEL, jsonify, request, jsonify, secure_filename, os, tempfile, json, documents_container, search_client_user, uuid
-from process_conversation import get_conversation_history, list_conversations, update_conversation_thread, delete_conversation_thread, add_system_message_to_conversation
-from process_content import extract_text_file, extract_markdown_file, extract_content_with_azure_di
+from config import openai, AZURE_OPENAI_LLM_MODEL, jsonify, request, jsonify, Response, stream_with_context, secure_filename, os, tempfile, json, documents_container, search_client_user, uuid, base64, AZURE_DOCUMENT_INTELLIGENCE_FILE_EXTENSIONS
+from process_conversation import get_conversation_history, list_conversations, update_conversation_thread, delete_conversation_thread, add_system_message_to_conversation, format_sse_event, build_chat_context, count_message_tokens
+from process_content import extract_file_text, extract_content_and_figures_with_azure_di
 from process_internet import get_bing_search_results, extract_snippets_from_results
+from process_document import federated_search
 
 #***************** Chat *****************
 # The chat routes handle the conversational AI functionality
@@ -12,56 +13,116 @@ def register_route_chat_user(app):
         user_id = data.get('user_id')
         message = data.get('message')
         conversation_id = data.get('conversation_id')  # Frontend can supply this
+        search_documents = data.get('search_documents', False)  # Ground the reply in the user's and groups' documents
+        group_ids = data.get('group_ids', [])
+        top_n = data.get('top_n', 5)
+        stream = data.get('stream', False)  # Relay the reply as Server-Sent Events while it is generated
 
         if not user_id or not message:
             return jsonify({'error': 'Missing user_id or message'}), 400
 
+        if search_documents and (not isinstance(top_n, int) or top_n < 1):
+            return jsonify({'error': 'top_n must be a positive integer'}), 400
+
         if not conversation_id:
             conversation_id = str(uuid.uuid4())
 
         # Retrieve conversation history (thread)
         conversation_history = get_conversation_history(conversation_id, user_id)
 
-        # Prepare messages for OpenAI API
-        messages = []
-        if conversation_history:
-            for entry in conversation_history['thread']:
-                if entry.get('role') == 'system':
-                    messages.append({
-                        "role": "system",
-                        "content": entry['content']
-                    })
-                else:
-                    messages.append({
-                        "role": "user",
-                        "content": entry['user_message']
-                    })
-                    messages.append({
-                        "role": "assistant",
-                        "content": entry['assistant_reply']
-                    })
+        # Add the most relevant document chunks for this message, fused across the user and group indexes
+        context_messages = []
+        document_results = []
+        if search_documents:
+            document_results, unavailable_sources = federated_search(message, user_id, group_ids, top_n)
+            if document_results:
+                combined_search = {
+                    "question": message,
+                    "document_results": [
+                        {
+                            "chunk_text": result['chunk_text'],
+                            "file_name": result['file_name'],
+                            "source": result['source']
+                        } for result in document_results
+                    ]
+                }
+                context_messages.append({
+                    "role": "system",
+                    "content": json.dumps(combined_search)
+                })
 
-        
         # Add the new user message
-        messages.append({
+        context_messages.append({
             "role": "user",
             "content": message
         })
 
+        # Prepare messages for OpenAI API: as much recent history as fits beside the
+        # new message and document results, with older turns replaced by a summary
+        history_messages, summary = build_chat_context(conversation_history, count_message_tokens(context_messages))
+        messages = history_messages + context_messages
+
+        sources = [
+            {"id": result['id'], "file_name": result['file_name'], "source": result['source']}
+            for result in document_results or []
+        ]
+
         # Call the OpenAI API
         try:
             response = openai.ChatCompletion.create(
                 engine=AZURE_OPENAI_LLM_MODEL,
-                messages=messages
+                messages=messages,
+                stream=stream
             )
+
+            if stream:
+                return Response(
+                    stream_with_context(generate_chat_events(response, conversation_id, user_id, message, sources, summary, conversation_history)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+                )
+
             reply = response['choices'][0]['message']['content']
 
             # Update the conversation thread in Cosmos DB using upsert
-            update_conversation_thread(conversation_id, user_id, message, reply)
+            update_conversation_thread(conversation_id, user_id, message, reply, summary, conversation_history)
 
-            return jsonify({'reply': reply, 'conversation_id': conversation_id}), 200
+            response_data = {'reply': reply, 'conversation_id': conversation_id}
+            if sources:
+                response_data['sources'] = sources
+            return jsonify(response_data), 200
         except Exception as e:
             return jsonify({'error': str(e)}), 500
+
+    def generate_chat_events(response, conversation_id, user_id, message, sources, summary, conversation_history):
+        # Relay each piece of the reply as it arrives, then store the whole reply.
+        # If the client disconnects the server closes this generator at its current
+        # yield; the finally block then closes the OpenAI stream and nothing is stored.
+        reply_parts = []
+        finished = False
+        try:
+            yield format_sse_event('start', {'conversation_id': conversation_id, 'sources': sources})
+
+            for chunk in response:
+                # Azure sends content filter results in chunks without choices
+                if not chunk['choices']:
+                    continue
+                delta = chunk['choices'][0].get('delta', {}).get('content')
+                if delta:
+                    reply_parts.append(delta)
+                    yield format_sse_event('delta', {'content': delta})
+            finished = True
+
+            # Update the conversation thread in Cosmos DB using upsert
+            reply = ''.join(reply_parts)
+            update_conversation_thread(conversation_id, user_id, message, reply, summary, conversation_history)
+            yield format_sse_event('done', {'reply': reply, 'conversation_id': conversation_id})
+
+        except Exception as e:
+            yield format_sse_event('error', {'error': str(e)})
+        finally:
+            if not finished and hasattr(response, 'close'):
+                response.close()
         
     @app.route('/api/chat/conversations', methods=['GET'])
     def get_conversations():
@@ -69,8 +130,29 @@ def register_route_chat_user(app):
         if not user_id:
             return jsonify({'error': 'Missing user_id'}), 400
         
+        page_size = request.args.get('page_size')
+        continuation_token = request.args.get('continuation_token')
+
+        if page_size is None and continuation_token:
+            return jsonify({'error': 'continuation_token requires page_size'}), 400
+
+        if page_size is not None:
+            if not page_size.isdigit() or int(page_size) < 1:
+                return jsonify({'error': 'page_size must be a positive integer'}), 400
+            page_size = int(page_size)
+
         # Fetch the list of conversations for the user
-        conversation_list = list_conversations(user_id)
+        try:
+            conversation_list, next_token = list_conversations(user_id, page_size, continuation_token)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        # A paged request always gets a page back, with the token for the next one when there is more
+        if page_size is not None:
+            response_data = {'conversations': conversation_list}
+            if next_token:
+                response_data['continuation_token'] = next_token
+            return jsonify(response_data), 200
         
         if conversation_list:
             return jsonify(conversation_list), 200
@@ -107,6 +189,7 @@ def register_route_chat_user(app):
         user_id = request.form.get('user_id')
         conversation_id = request.form.get('conversation_id')
         file = request.files.get('file')
+        include_figures = request.form.get('include_figures', 'false').lower() == 'true'
 
         if not user_id:
             return jsonify({'error': 'Missing user_id'}), 400
@@ -125,23 +208,18 @@ def register_route_chat_user(app):
         filename = secure_filename(file.filename)
         file_ext = os.path.splitext(filename)[1].lower()
 
-        with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
-            file.save(tmp_file.name)
-            temp_file_path = tmp_file.name
-
         extracted_text = ''
         parsed_json = None
+        figures = None
 
         try:
-            if file_ext in ['.pdf', '.docx', '.xlsx', '.pptx', '.html', '.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif', '.heif']:
-                extracted_text = extract_content_with_azure_di(temp_file_path)
-            elif file_ext == '.txt':
-                extracted_text = extract_text_file(temp_file_path)
-            elif file_ext == '.md':
-                extracted_text = extract_markdown_file(temp_file_path)
+            if file_ext in AZURE_DOCUMENT_INTELLIGENCE_FILE_EXTENSIONS and include_figures:
+                extracted_text, figures = extract_content_and_figures_with_azure_di(file.stream)
+            elif file_ext in AZURE_DOCUMENT_INTELLIGENCE_FILE_EXTENSIONS + ['.txt', '.md']:
+                # Shares the extraction cache with document uploads
+                extracted_text = extract_file_text(file.stream, file_ext)
             elif file_ext == '.json':
-                with open(temp_file_path, 'r', encoding='utf-8') as f:
-                    parsed_json = json.load(f)
+                parsed_json = json.load(file.stream)
             else:
                 return jsonify({'error': 'Unsupported file type'}), 400
 
@@ -153,12 +231,10 @@ def register_route_chat_user(app):
 
         except Exception as e:
             return jsonify({'error': f'Error processing file: {str(e)}'}), 500
-        finally:
-            os.remove(temp_file_path)
 
         # Add the extracted content to the conversation
         try:
-            add_system_message_to_conversation(conversation_id, user_id, extracted_text)
+            add_system_message_to_conversation(conversation_id, user_id, extracted_text, conversation_history)
         except Exception as e:
             return jsonify({'error': f'Error adding file content to conversation: {str(e)}'}), 500
 
@@ -169,6 +245,14 @@ def register_route_chat_user(app):
             response_data['extracted_json'] = parsed_json
         else:
             response_data['extracted_text'] = extracted_text
+        if figures is not None:
+            response_data['figures'] = [
+                {
+                    'figure_id': figure['figure_id'],
+                    'caption': figure['caption'],
+                    'image': base64.b64encode(figure['image']).decode('ascii')
+                } for figure in figures
+            ]
 
         return jsonify(response_data), 200
 
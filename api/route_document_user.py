@@ -1,6 +1,7 @@
-from config import jsonify, request, jsonify, documents_container, search_client_user
+from config import jsonify, request, jsonify, documents_container, search_client_user, SEARCH_BATCH_MAX_QUERIES, Response, stream_with_context, itertools, json
 from process_content import generate_embedding
-from process_document import get_user_documents, upload_user_document, get_user_documents, delete_user_document, delete_user_document_chunks, get_user_document, get_latest_version, delete_user_document_version, delete_user_document_version_chunks, get_user_document_version, hybrid_search
+from process_document import get_user_documents, upload_user_document, get_user_documents, delete_user_document, delete_user_document_chunks, get_user_document, get_latest_version, delete_user_document_version, delete_user_document_version_chunks, get_user_document_version, hybrid_search, encode_continuation_token, decode_continuation_token, SEARCH_RESULT_FIELDS, SEARCH_RESULT_ID_FIELDS, batch_hybrid_search, format_search_result, reranked_hybrid_search, iter_document_chunks, reassemble_document_text, CHUNK_EXPORT_FORMATS, get_document_chunk_count, start_deletion_job, federated_search
+from process_jobs import get_job, format_job
 
 #***************** Documents *****************
 # The documents routes handle the document management functionality
@@ -30,6 +31,25 @@ def register_route_document_user(app):
 
 
 
+    @app.route('/api/documents/jobs/<job_id>', methods=['GET'])
+    def get_document_job(job_id):
+        user_id = request.args.get('user_id')
+
+        if not user_id:
+            return jsonify({'error': 'Missing user_id'}), 400
+
+        try:
+            # Report the progress of a background ingestion job
+            job = get_job(job_id, user_id)
+
+            if not job:
+                return jsonify({'error': 'Job not found or access denied'}), 404
+
+            return jsonify(format_job(job)), 200
+
+        except Exception as e:
+            return jsonify({'error': f'Error retrieving job: {str(e)}'}), 500
+
     @app.route('/api/documents/<document_id>', methods=['GET', 'DELETE'])
     def handle_specific_document(document_id):
         # Log the request method and document ID
@@ -53,13 +73,21 @@ def register_route_document_user(app):
             # Handle DELETE request: Delete all versions of the document
             ##print(f"Handling DELETE request for document ID: {document_id}")
             try:
-                # Step 1: Delete document metadata from Cosmos DB
+                # Step 1: Read the chunk count before the metadata that records it is gone
+                chunk_count = get_document_chunk_count(user_id, document_id)
+
+                # Step 2: Delete document metadata from Cosmos DB
                 ##print(f"Deleting document metadata for document ID: {document_id}")
                 delete_user_document(user_id, document_id)
 
-                # Step 2: Delete all associated chunks from Azure AI Search
+                # Step 3: Delete all associated chunks from the search index, in the background if asked
                 ##print(f"Deleting document chunks for document ID: {document_id}")
-                delete_user_document_chunks(document_id)
+                if request.values.get('background', 'false').lower() == 'true':
+                    response_data = start_deletion_job(user_id, document_id, chunk_count)
+                    response_data['message'] = 'Document deleted, its chunks are being removed'
+                    return jsonify(response_data), 202
+
+                delete_user_document_chunks(document_id, user_id, chunk_count)
 
                 ##print(f"Document ID {document_id} and all versions deleted successfully")
                 return jsonify({'message': 'Document and all versions deleted successfully'}), 200
@@ -106,67 +134,97 @@ def register_route_document_user(app):
         if not user_id:
             return jsonify({'error': 'Missing user_id'}), 400
 
+        # Versions are stored as integers, so the URL value must be converted before querying
+        if not version.isdigit():
+            return jsonify({'error': 'version must be an integer'}), 400
+        version = int(version)
+
         if request.method == 'GET':
             # Handle GET request: Retrieve a specific version of the document
             return get_user_document_version(user_id, document_id, version)
         
         elif request.method == 'DELETE':
             try:
-                # Step 1: Delete the specific version from Cosmos DB
+                # Step 1: Read the chunk count before the metadata that records it is gone
+                chunk_count = get_document_chunk_count(user_id, document_id, version)
+
+                # Step 2: Delete the specific version from Cosmos DB
                 delete_user_document_version(user_id, document_id, version)
 
-                # Step 2: Delete associated chunks for that version from Azure AI Search
-                delete_user_document_version_chunks(document_id, version)
+                # Step 3: Delete associated chunks for that version from the search index, in the background if asked
+                if request.values.get('background', 'false').lower() == 'true':
+                    response_data = start_deletion_job(user_id, document_id, chunk_count, version)
+                    response_data['message'] = 'Document version deleted, its chunks are being removed'
+                    return jsonify(response_data), 202
+
+                delete_user_document_version_chunks(document_id, version, user_id, chunk_count)
 
                 return jsonify({'message': 'Document version and its associated chunks deleted successfully'}), 200
 
             except Exception as e:
                 return jsonify({'error': f'Error deleting document version: {str(e)}'}), 500
         
+    def format_document_chunk(chunk):
+        return {
+            "id": chunk['id'],
+            "chunk_text": chunk['chunk_text'],
+            "chunk_id": chunk['chunk_id'],
+            "chunk_sequence": chunk['chunk_sequence'],
+            "version": chunk['version']  # Include version in the response
+        }
+
+    def document_chunks_response(chunks, output_format, not_found_message):
+        # Fetch the first chunk up front so a missing document is still a 404
+        first_chunk = next(chunks, None)
+        if first_chunk is None:
+            return jsonify({'error': not_found_message}), 404
+        chunks = itertools.chain([first_chunk], chunks)
+
+        if output_format == 'json':
+            return jsonify({"chunks": [format_document_chunk(chunk) for chunk in chunks]}), 200
+
+        if output_format == 'text':
+            def generate_text():
+                # Reassemble the full document text as the chunks arrive; a failure part way
+                # through ends the text with an error marker line so it is never silently cut short
+                try:
+                    yield from reassemble_document_text(chunks)
+                except Exception as e:
+                    yield f'\n[ERROR] Error retrieving chunks: {str(e)}\n'
+
+            return Response(stream_with_context(generate_text()), mimetype='text/plain')
+
+        def generate_ndjson():
+            # One chunk per line, in sequence order; a failure part way through is reported as a last line
+            try:
+                for chunk in chunks:
+                    yield json.dumps(format_document_chunk(chunk)) + '\n'
+            except Exception as e:
+                yield json.dumps({'error': f'Error retrieving chunks: {str(e)}'}) + '\n'
+
+        return Response(stream_with_context(generate_ndjson()), mimetype='application/x-ndjson')
+
     @app.route('/api/documents/<document_id>/chunks', methods=['GET'])
     def get_document_chunks(document_id):
         ##print(f"Function get_document_chunks called for document_id: {document_id}")
 
         # Retrieve user_id from query parameters
         user_id = request.args.get('user_id')
+        output_format = request.args.get('format', 'json')  # json, ndjson or text
         ##print(f"User ID: {user_id}")
 
         if not user_id:
             ##print("Error: Missing user_id")
             return jsonify({'error': 'Missing user_id'}), 400
 
-        try:
-            # Step 1: Get the latest version for the specified document and user
-            latest_version = get_latest_version(document_id, user_id)
-            ##print(f"Latest version for document_id {document_id} and user_id {user_id}: {latest_version}")
-
-            if latest_version is None:
-                ##print("No chunks found for the specified document and user")
-                return jsonify({'error': 'No chunks found for the specified document and user'}), 404
-
-            # Step 2: Search for chunks matching document_id, user_id, and latest version
-            ##print(f"Searching for chunks with document_id: {document_id}, user_id: {user_id}, version: {latest_version}")
-            search_results = search_client_user.search(
-                search_text="*",
-                filter=f"document_id eq '{document_id}' and user_id eq '{user_id}' and version eq {latest_version}",
-                top=100,
-                select="id, chunk_text, chunk_id, version"
-            )
-
-            # Collect the chunks into a list
-            chunks = []
-            for result in search_results:
-                chunk_info = {
-                    "id": result['id'],
-                    "chunk_text": result['chunk_text'],
-                    "chunk_id": result['chunk_id'],
-                    "version": result['version']  # Include version in the response
-                }
-                ##print(f"Found chunk: {chunk_info}")
-                chunks.append(chunk_info)
+        if output_format not in CHUNK_EXPORT_FORMATS:
+            return jsonify({'error': f'format must be one of {", ".join(CHUNK_EXPORT_FORMATS)}'}), 400
 
-            ##print(f"Total chunks found: {len(chunks)}")
-            return jsonify({"chunks": chunks}), 200
+        try:
+            # Walk every chunk of the document's current version in sequence order
+            ##print(f"Searching for current chunks with document_id: {document_id}, user_id: {user_id}")
+            chunks = iter_document_chunks(user_id, document_id, current_only=True)
+            return document_chunks_response(chunks, output_format, 'No chunks found for the specified document and user')
 
         except Exception as e:
             ##print(f"Error retrieving chunks: {str(e)}")
@@ -176,33 +234,21 @@ def register_route_document_user(app):
     @app.route('/api/documents/<document_id>/version/<version>/chunks', methods=['GET'])
     def get_chunks_of_specific_version(document_id, version):
         user_id = request.args.get('user_id')
+        output_format = request.args.get('format', 'json')  # json, ndjson or text
 
         if not user_id:
             return jsonify({'error': 'Missing user_id'}), 400
 
+        if output_format not in CHUNK_EXPORT_FORMATS:
+            return jsonify({'error': f'format must be one of {", ".join(CHUNK_EXPORT_FORMATS)}'}), 400
+
+        if not version.isdigit():
+            return jsonify({'error': 'version must be an integer'}), 400
+
         try:
-            # Step 1: Search for chunks that match the document_id, user_id, and specified version
-            search_results = search_client_user.search(
-                search_text="*",
-                filter=f"document_id eq '{document_id}' and user_id eq '{user_id}' and version eq {version}",
-                top=100,
-                select="id, chunk_text, chunk_id, version"
-            )
-
-            # Collect the chunks into a list
-            chunks = []
-            for result in search_results:
-                chunks.append({
-                    "id": result['id'],
-                    "chunk_text": result['chunk_text'],
-                    "chunk_id": result['chunk_id'],
-                    "version": result['version']  # Include version in the response
-                })
-
-            if not chunks:
-                return jsonify({'error': 'No chunks found for the specified document version'}), 404
-
-            return jsonify({"chunks": chunks}), 200
+            # Walk every chunk of the specified version in sequence order
+            chunks = iter_document_chunks(user_id, document_id, version=int(version))
+            return document_chunks_response(chunks, output_format, 'No chunks found for the specified document version')
 
         except Exception as e:
             return jsonify({'error': f'Error retrieving chunks: {str(e)}'}), 500
@@ -217,6 +263,13 @@ def register_route_document_user(app):
         user_id = data.get('user_id')
         search_query = data.get('query')
         top_n = data.get('top_n', 5)  # Default to returning top 5 results if not specified
+        continuation_token = data.get('continuation_token')
+        ids_only = data.get('ids_only', False)  # Only return ids and scores, for re-ranking clients
+        mmr = data.get('mmr', False)  # Re-rank for diversity with Maximal Marginal Relevance
+        mmr_lambda = data.get('mmr_lambda', 0.5)  # 1 ranks purely by relevance, 0 purely by diversity
+        merge_adjacent = data.get('merge_adjacent', False)  # Join consecutive chunks into one passage
+        scope = data.get('scope', 'user')  # 'federated' also searches the group index and fuses the rankings
+        group_ids = data.get('group_ids', [])
 
         ##print(f"user_id: {user_id}, search_query: {search_query}, top_n: {top_n}")
 
@@ -224,9 +277,58 @@ def register_route_document_user(app):
             ##print("Error: Missing user_id or query")
             return jsonify({'error': 'Missing user_id or query'}), 400
 
+        try:
+            top_n = int(top_n)
+            if top_n < 1:
+                raise ValueError()
+        except (TypeError, ValueError):
+            return jsonify({'error': 'top_n must be a positive integer'}), 400
+
+        try:
+            mmr_lambda = float(mmr_lambda)
+            if not 0 <= mmr_lambda <= 1:
+                raise ValueError()
+        except (TypeError, ValueError):
+            return jsonify({'error': 'mmr_lambda must be a number between 0 and 1'}), 400
+
+        # Re-ranked results are chosen from the whole candidate pool, so they cannot be paged
+        reranked = mmr or merge_adjacent
+        if reranked and continuation_token:
+            return jsonify({'error': 'continuation_token cannot be combined with mmr or merge_adjacent'}), 400
+
+        if scope not in ['user', 'federated']:
+            return jsonify({'error': "scope must be 'user' or 'federated'"}), 400
+
+        if not isinstance(group_ids, list) or not all(isinstance(group_id, str) and group_id for group_id in group_ids):
+            return jsonify({'error': 'group_ids must be a list of non-empty strings'}), 400
+
+        # Fused rankings span several indexes, so they are neither paged nor re-ranked
+        federated = scope == 'federated'
+        if federated and (reranked or continuation_token):
+            return jsonify({'error': 'federated scope cannot be combined with continuation_token, mmr or merge_adjacent'}), 400
+
+        # Resume from where the previous page ended
+        skip = 0
+        if continuation_token:
+            try:
+                skip = decode_continuation_token(continuation_token, search_query)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+
         try:
             ##print(f"Searching for top {top_n} chunks for user_id: {user_id}")
-            results = hybrid_search(search_query, user_id, top_n)
+            unavailable_sources = []
+            if federated:
+                select = SEARCH_RESULT_ID_FIELDS if ids_only else SEARCH_RESULT_FIELDS
+                results, unavailable_sources = federated_search(search_query, user_id, group_ids, top_n, select)
+            elif reranked:
+                results = reranked_hybrid_search(search_query, user_id, top_n, mmr, mmr_lambda, merge_adjacent)
+            else:
+                select = SEARCH_RESULT_ID_FIELDS if ids_only else SEARCH_RESULT_FIELDS
+                results = hybrid_search(search_query, user_id, top_n, skip, select)
+
+            if results is None:
+                return jsonify({'error': 'Error during search'}), 500
 
             # Step 3: Prepare the response with the top chunks
             top_chunks = []
@@ -234,19 +336,8 @@ def register_route_document_user(app):
 
             for result in results:
                 ##print(f"Result: {result}")
-                
-                chunk_info = {
-                    "chunk_id": result["chunk_id"],
-                    "chunk_text": result["chunk_text"],
-                    "similarity_score": result["@search.score"],  # Similarity score returned by Azure Cognitive Search
-                    "metadata": {
-                        "file_name": result["file_name"],
-                        "user_id": result["user_id"],
-                        "chunk_sequence": result["chunk_sequence"],
-                        "upload_date": result["upload_date"],
-                        "version": result["version"]
-                    }
-                }
+
+                chunk_info = format_search_result(result, ids_only)
                 ##print(f"Found chunk: {chunk_info}")
                 top_chunks.append(chunk_info)
 
@@ -258,6 +349,14 @@ def register_route_document_user(app):
                 "top_chunks": top_chunks
             }
 
+            # Name the sources that failed or ran past their latency budget
+            if unavailable_sources:
+                response_data["unavailable_sources"] = unavailable_sources
+
+            # A full page means there may be more results
+            if not reranked and not federated and len(results) == top_n:
+                response_data["continuation_token"] = encode_continuation_token(search_query, skip + top_n)
+
             return jsonify(response_data), 200
 
         except Exception as e:
@@ -265,3 +364,51 @@ def register_route_document_user(app):
             return jsonify({'error': f'Error during search: {str(e)}'}), 500
 
 
+    @app.route('/api/documents/search/batch', methods=['POST'])
+    def search_document_chunks_batch():
+        # Get data from the request
+        data = request.get_json()
+        user_id = data.get('user_id')
+        queries = data.get('queries')
+        top_n = data.get('top_n', 5)  # Default to returning top 5 results per query if not specified
+        ids_only = data.get('ids_only', False)
+        deduplicate = data.get('deduplicate', False)  # Keep each chunk only under its best-scoring query
+
+        if not user_id or not queries:
+            return jsonify({'error': 'Missing user_id or queries'}), 400
+
+        if not isinstance(queries, list) or not all(isinstance(query, str) and query for query in queries):
+            return jsonify({'error': 'queries must be a list of non-empty strings'}), 400
+
+        if len(queries) > SEARCH_BATCH_MAX_QUERIES:
+            return jsonify({'error': f'At most {SEARCH_BATCH_MAX_QUERIES} queries are allowed per batch'}), 400
+
+        try:
+            top_n = int(top_n)
+            if top_n < 1:
+                raise ValueError()
+        except (TypeError, ValueError):
+            return jsonify({'error': 'top_n must be a positive integer'}), 400
+
+        try:
+            select = SEARCH_RESULT_ID_FIELDS if ids_only else SEARCH_RESULT_FIELDS
+            batch_results = batch_hybrid_search(queries, user_id, top_n, select, deduplicate)
+
+            if batch_results is None:
+                return jsonify({'error': 'Error during search'}), 500
+
+            # Return the top chunks of every query, in request order
+            response_data = {
+                "results": [
+                    {
+                        "query": query,
+                        "top_chunks": [format_search_result(result, ids_only) for result in results]
+                    }
+                    for query, results in zip(queries, batch_results)
+                ]
+            }
+
+            return jsonify(response_data), 200
+
+        except Exception as e:
+            return jsonify({'error': f'Error during search: {str(e)}'}), 500